@@ -0,0 +1,194 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import namedtuple
+
+
+CacheEntry = namedtuple('CacheEntry', ('body', 'etag', 'last_modified', 'parse_seconds', 'fresh'))
+
+
+class NotModified(str):
+    """
+    Cached response body reused after a 304 Not Modified response.
+    """
+    pass
+
+
+class ResponseCache:
+    """
+    On-disk response cache backed by SQLite, keyed by request fingerprint.
+    Entries expire after ttl seconds, least recently used entries are evicted above max size.
+    ETag and Last-Modified validators are kept with the body for conditional requests.
+    """
+
+    MODES = ('off', 'read', 'write', 'readwrite')
+    COMMIT_EVERY = 100
+
+    def __init__(self, path, mode='readwrite', ttl=None, max_size=None):
+        """
+        :param path: SQLite database file
+        :param mode: off, read, write or readwrite
+        :param ttl: seconds before entries expire, None for never
+        :param max_size: max bytes of bodies, None for no limit
+        """
+        if mode not in self.MODES:
+            raise ValueError('Invalid cache mode %s' % (mode, ))
+        self.path = path
+        self.mode = mode
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._pending = 0
+        d = os.path.dirname(path)
+        if d and not os.path.exists(d):
+            os.makedirs(d)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                           'key TEXT PRIMARY KEY, body TEXT, size INTEGER, created REAL, accessed REAL, '
+                           'etag TEXT, last_modified TEXT, parse_seconds REAL)')
+        columns = set(row[1] for row in self._conn.execute('PRAGMA table_info(responses)'))
+        for column, t in (('etag', 'TEXT'), ('last_modified', 'TEXT'), ('parse_seconds', 'REAL')):
+            if column not in columns:  # cache created by an older version
+                self._conn.execute('ALTER TABLE responses ADD COLUMN %s %s' % (column, t))
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self._size = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @property
+    def readable(self):
+        return self.mode in ('read', 'readwrite')
+
+    @property
+    def writable(self):
+        return self.mode in ('write', 'readwrite')
+
+    @staticmethod
+    def fingerprint(method, url, params=None, data=None):
+        """
+        Hash of method, url, params and body.
+        :return: hex digest
+        """
+        h = hashlib.sha1()
+        h.update(method.upper().encode('utf-8'))
+        h.update(b'\0' + url.encode('utf-8'))
+        h.update(b'\0' + json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        elif data is not None and not isinstance(data, bytes):
+            data = json.dumps(data, sort_keys=True, default=str).encode('utf-8')
+        h.update(b'\0' + (data or b''))
+        return h.hexdigest()
+
+    def get(self, key):
+        """
+        Get cached body, None if missing or expired.
+        :param key:
+        :return: body
+        """
+        if not self.readable:
+            return None
+        row = self._conn.execute('SELECT body, created FROM responses WHERE key = ?', (key, )).fetchone()
+        now = time.time()
+        if row is None or (self.ttl and now - row[1] > self.ttl):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        self._commit_later()
+        return row[0]
+
+    def lookup(self, key):
+        """
+        Get cached entry with validators, expired entries are returned too for revalidation.
+        :param key:
+        :return: entry or None
+        :rtype: CacheEntry
+        """
+        if not self.readable:
+            return None
+        row = self._conn.execute('SELECT body, created, etag, last_modified, parse_seconds FROM responses '
+                                 'WHERE key = ?', (key, )).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        fresh = not self.ttl or time.time() - row[1] <= self.ttl
+        if fresh:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return CacheEntry(row[0], row[2], row[3], row[4], fresh)
+
+    def touch(self, key):
+        """
+        Mark entry as revalidated, it is fresh for another ttl.
+        :param key:
+        :return:
+        """
+        now = time.time()
+        self._conn.execute('UPDATE responses SET created = ?, accessed = ? WHERE key = ?', (now, now, key))
+        self._commit_later()
+
+    def set_parse_seconds(self, key, seconds):
+        """
+        Record time spent to parse the body and run pipelines, reported as saved when the body is not modified.
+        Called only when processing succeeded, entries without it are not revalidated.
+        :param key:
+        :param float seconds:
+        :return:
+        """
+        self._conn.execute('UPDATE responses SET parse_seconds = ? WHERE key = ?', (seconds, key))
+        self._commit_later()
+
+    def set(self, key, body, etag=None, last_modified=None):
+        """
+        Store body, parse seconds of a replaced entry are cleared.
+        :param key:
+        :param body:
+        :param etag: ETag header of response
+        :param last_modified: Last-Modified header of response
+        :return:
+        """
+        if not self.writable:
+            return
+        now = time.time()
+        size = len(body)
+        old = self._conn.execute('SELECT size FROM responses WHERE key = ?', (key, )).fetchone()
+        if old is not None:
+            self._size -= old[0]
+        self._conn.execute('INSERT OR REPLACE INTO responses (key, body, size, created, accessed, etag, last_modified) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?)', (key, body, size, now, now, etag, last_modified))
+        self._size += size
+        if self.max_size and self._size > self.max_size:
+            self.evict(int(self.max_size * 0.9))
+        self._commit_later()
+
+    def evict(self, target):
+        """
+        Evict least recently used entries until total size is under target.
+        :param int target: bytes
+        :return:
+        """
+        keys = []
+        for key, size in self._conn.execute('SELECT key, size FROM responses ORDER BY accessed'):
+            if self._size <= target:
+                break
+            keys.append((key, ))
+            self._size -= size
+        self._conn.executemany('DELETE FROM responses WHERE key = ?', keys)
+        logging.debug('Evict %d cached responses' % (len(keys), ))
+
+    def _commit_later(self):
+        self._pending += 1
+        if self._pending >= self.COMMIT_EVERY:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+            logging.info('Response cache %d hits, %d misses' % (self.hits, self.misses))
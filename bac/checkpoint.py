@@ -0,0 +1,79 @@
+import logging
+import os
+import time
+from bac.ids import IntSet, rs_number
+
+
+class CheckpointJournal:
+    """
+    Append-only journal of ids in completed requests, one id per line.
+    """
+
+    def __init__(self, path, resume=False, flush_interval=5):
+        """
+        :param path: journal file
+        :param bool resume: load done ids and append, otherwise start a new journal
+        :param float flush_interval: seconds between flushes
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self._done = IntSet()
+        self._done_other = set()
+        if resume and os.path.exists(path):
+            self.load()
+        d = os.path.dirname(path)
+        if d and not os.path.exists(d):
+            os.makedirs(d)
+        self._fp = open(path, 'a' if resume else 'w')
+        self._flushed = time.time()
+
+    def load(self):
+        """
+        Load done ids from journal.
+        :return:
+        """
+        with open(self.path) as fp:
+            for l in fp:
+                l = l.strip()
+                if l:
+                    self._mark(l)
+        logging.info('Resume from %s, %d ids done' % (self.path, self.count()))
+
+    def _mark(self, snp):
+        n = rs_number(snp)
+        if n is None:
+            self._done_other.add(snp)
+        else:
+            self._done.add(n)
+
+    def is_done(self, snp):
+        """
+        Whether id is done in previous run.
+        :param snp:
+        :return: bool
+        """
+        n = rs_number(snp)
+        if n is None:
+            return snp.strip() in self._done_other
+        return n in self._done
+
+    def count(self):
+        return len(self._done) + len(self._done_other)
+
+    def add(self, ids):
+        """
+        Record ids of a completed request.
+        :param ids:
+        :return:
+        """
+        for i in ids:
+            self._fp.write(str(i) + '\n')
+        now = time.time()
+        if now - self._flushed >= self.flush_interval:
+            self._fp.flush()
+            self._flushed = now
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
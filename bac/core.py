@@ -1,55 +1,183 @@
+import argparse
 import logging
 import json
 import bac.utils
+import sys
+import threading
 import time
+from bac.checkpoint import CheckpointJournal
+from bac.stats import CrawlStats
+try:
+    import orjson
+except ImportError:  # orjson is optional, then ujson and json
+    orjson = None
+    try:
+        import ujson
+    except ImportError:
+        ujson = None
+
+
+if orjson is not None:
+    def dumps_bytes(obj, sort_keys=False):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else None)
+    loads_bytes = orjson.loads
+elif ujson is not None:
+    def dumps_bytes(obj, sort_keys=False):
+        return ujson.dumps(obj, ensure_ascii=False, sort_keys=sort_keys).encode('utf-8')
+    loads_bytes = ujson.loads
+else:
+    def dumps_bytes(obj, sort_keys=False):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), sort_keys=sort_keys).encode('utf-8')
+    loads_bytes = json.loads
 
 
 class Engine:
     """
     Crawler engine.
     """
+    ACTIONS = ['help', 'version', 'list', 'crawl']
+
     def __init__(self, config):
         self._config = config
         self._options = {}
         self._crawlers = {}
         self._crawler = None
         self._pipelines = []
+        self._loop = None
+        self._executor = None
+        self._parse_executor = None
+        self._journal = None
+        self._unstored = []  # [ids, storage pipelines not flushed yet] of completed requests
+        self._checkpoint_lock = threading.Lock()
+        self._metrics_server = None
+        self.stats = CrawlStats()
         self._version = 'v0.1'
         self._descr = 'Bioinfomatics API crawler'
         self._start = time.time()
 
-    def init_crawler(self, argparser):
+    def init_crawler(self, argparser, argv=None):
         """
         Initialize engine.
+        Only the crawler given by -c and pipelines are imported and add arguments, for crawl action.
         :param argparser:
+        :param argv: command line to be parsed, default sys.argv
         :return:
         """
+        # find action and crawler by scanning first, so other crawlers and pipelines are not imported,
+        # options of crawler and pipelines are unknown yet, a parser would take their values as action
+        argv = sys.argv[1:] if argv is None else list(argv)
+        action = next((a for a in argv if a in self.ACTIONS), None)
+        crawler = self.option_value(argv, '-c', '--crawler')
+        if '--import-profile' in argv:
+            bac.utils.ImportProfiler.install()
         # add arguments
-        argparser.add_argument('action', help="Crawler action", choices=['help', 'version', 'list', 'crawl'])
+        argparser.add_argument('action', help="Crawler action", choices=self.ACTIONS)
+        self.add_engine_arguments(argparser)
+        if action != 'crawl' or crawler not in self._config.CRAWLERS:
+            return
+        # init crawler
+        self.load_crawler(crawler).add_arguments(argparser)
+        # init pipelines
+        for p in self._config.PIPELINES:
+            par = self.load_class(p)()
+            par.add_arguments(argparser)
+            self._pipelines.append(par)
+
+    @staticmethod
+    def option_value(argv, short, long):
+        """
+        Find value of an option in command line without parsing, e.g. variation for -c variation.
+        :param list argv:
+        :param short: e.g. -c
+        :param long: e.g. --crawler
+        :return: value or None
+        """
+        for i, a in enumerate(argv):
+            if a in (short, long):
+                return argv[i + 1] if i + 1 < len(argv) else None
+            if a.startswith(long + '='):
+                return a[len(long) + 1:]
+            if a.startswith(short) and not a.startswith('--'):
+                return a[len(short):]
+        return None
+
+    def add_engine_arguments(self, argparser):
+        """
+        Add arguments of engine, all but action.
+        :param argparser:
+        :return:
+        """
+        from bac.inputs import INPUT_FORMATS
         argparser.add_argument('-V', '--verbose', help="Print more information", action="store_true")
-        argparser.add_argument('-c', '--crawler', help="Crawler name")
+        argparser.add_argument('-c', '--crawler', help="Crawler name, crawl -c <name> -h shows its arguments",
+                               choices=list(self._config.CRAWLERS))
+        argparser.add_argument('--import-profile', help="Print import time of modules at exit", action="store_true")
         argparser.add_argument('--logger', help="Change log output")
         argparser.add_argument('--logfile', help="Change log file path")
         argparser.add_argument('--loglevel', help="Change log level")
-        argparser.add_argument('--speed-limit', help="Whether sleep after process some data, default false", action="store_true")
-        argparser.add_argument('--limit-num', help="Sleep after how many requests", type=int)
-        argparser.add_argument('--sleep-sec', help="Sleep seconds", type=int)
-        # init crawlers
-        crawlers = self._config.CRAWLERS
-        for category, p in crawlers.items():
-            pkg, cls = bac.utils.split_class(p)
-            pr = __import__(pkg, fromlist=True)
-            par = getattr(pr, cls)(category)
-            self._crawlers[category] = par
-            par.add_arguments(argparser)
-        # init pipelines
-        pipelines = self._config.PIPELINES
-        for p in pipelines:
-            pkg, cls = bac.utils.split_class(p)
-            pr = __import__(pkg, fromlist=True)
-            par = getattr(pr, cls)()
-            par.add_arguments(argparser)
-            self._pipelines.append(par)
+        argparser.add_argument('--rate-limit', help="Max requests per second to each host", type=float)
+        argparser.add_argument('--rate-burst', help="Requests allowed in a burst after idle", type=int)
+        argparser.add_argument('--concurrency', help="Max concurrent requests", type=int)
+        argparser.add_argument('--batch-num', help="Ids for each batch request", type=int)
+        argparser.add_argument('--pipeline-workers', help="Threads to parse responses and run pipelines", type=int)
+        argparser.add_argument('--parse-workers', help="Processes to parse responses, 0 to parse in pipeline threads",
+                               type=int)
+        argparser.add_argument('--stage-queue', help="Max responses waiting for pipeline workers", type=int)
+        argparser.add_argument('--pool-size', help="Max connections in the pool, 0 for no limit", type=int)
+        argparser.add_argument('--pool-per-host', help="Max connections to each host, 0 for no limit", type=int)
+        argparser.add_argument('--keepalive-timeout', help="Seconds to keep idle connections alive", type=float)
+        argparser.add_argument('--dns-ttl', help="Seconds to cache DNS results", type=int)
+        argparser.add_argument('--timeout', help="Seconds before a request times out", type=float)
+        argparser.add_argument('--max-retries', help="Max retries for each failed request", type=int)
+        argparser.add_argument('--retry-backoff', help="Base seconds of exponential retry backoff", type=float)
+        argparser.add_argument('--dead-letter', help="File to append ids of requests failed finally")
+        argparser.add_argument('--progress-interval', help="Seconds between progress lines, 0 to disable",
+                               type=float)
+        argparser.add_argument('--stats-file', help="Write crawl stats to json file at close")
+        argparser.add_argument('--metrics-port', help="Serve Prometheus metrics on this port", type=int)
+        argparser.add_argument('--input-format', help="Format of input id file, default by file name, "
+                                                      "gzip, bgzip and zstd are detected",
+                               choices=sorted(set(INPUT_FORMATS) | set(self.get_config('INPUT_READERS') or {})))
+        argparser.add_argument('--input-column', help="Id column name or 1-based number of tsv input")
+        argparser.add_argument('--input-buffer', help="KB of input read buffer", type=int)
+        argparser.add_argument('--merged-ids', help="File of merged and current rs ids to collapse merged ids")
+        argparser.add_argument('--checkpoint', help="Journal file of ids in completed requests")
+        argparser.add_argument('--resume', help="Skip ids done in journal of previous run", action="store_true")
+        argparser.add_argument('--cache-dir', help="Directory of response cache")
+        argparser.add_argument('--cache-mode', help="Response cache mode, default readwrite",
+                               choices=['off', 'read', 'write', 'readwrite'])
+        argparser.add_argument('--cache-ttl', help="Seconds before cached responses expire", type=float)
+        argparser.add_argument('--cache-size', help="Max MB of cached responses", type=float)
+        argparser.add_argument('--shards', help="Split input ids into shards by hash of rs number", type=int)
+        argparser.add_argument('--shard-index', help="Crawl only this shard, 0 ~ shards - 1, "
+                                                     "otherwise run all shards in worker processes", type=int)
+        argparser.add_argument('--shard-workers', help="Max shard worker processes at the same time", type=int)
+        argparser.add_argument('--work-queue', help="SQLite lease table of shards shared by nodes")
+        argparser.add_argument('--lease-timeout', help="Seconds before lease of a shard of dead node expires",
+                               type=float)
+        argparser.add_argument('--conditional', help="Revalidate cached responses by ETag or Last-Modified, "
+                                                     "skip pipelines if not modified", action="store_true")
+
+    @staticmethod
+    def load_class(name):
+        """
+        Import class by full name.
+        :param name: e.g. bac.pipelines.JsonLinePipeline
+        :return: class
+        """
+        pkg, cls = bac.utils.split_class(name)
+        return getattr(__import__(pkg, fromlist=True), cls)
+
+    def load_crawler(self, category):
+        """
+        Import and create crawler of category in CRAWLERS config.
+        :param category:
+        :return: crawler
+        :rtype: BaseCrawler
+        """
+        if category not in self._crawlers:
+            self._crawlers[category] = self.load_class(self._config.CRAWLERS[category])(category)
+        return self._crawlers[category]
 
     def parse_arguments(self, args):
         """
@@ -113,12 +241,69 @@ class Engine:
             logging.basicConfig(level=lv, format=logformat, datefmt=datefmt)
 
     def start(self, category):
+        if self.shard is None and (self.get_setting('shards', 'SHARDS') or 1) > 1:
+            self.coordinate()
+            return
         self.open_crawler(category)
-        self.crawl(category)
-        self.close_crawler()
+        try:
+            self.crawl(category)
+        finally:  # flush storage pipelines and journal even if the crawl failed
+            self.close_crawler()
+        logging.info(self.stats.summary())
         runtime = time.time() - self._start
         logging.info('Finish! Run time %s ' % str(runtime))
 
+    def coordinate(self):
+        """
+        Run shards of the crawl in worker processes by the same command line.
+        :return:
+        :raise CrawlerException: if any shard failed
+        """
+        from bac.shard import ShardCoordinator, ShardLeases
+        self.init_logger()
+        shards = self.get_setting('shards', 'SHARDS')
+        leases = None
+        work_queue = self.get_setting('work_queue', 'WORK_QUEUE')
+        if work_queue:
+            leases = ShardLeases(work_queue, shards, self.get_setting('lease_timeout', 'LEASE_TIMEOUT', 600))
+        coordinator = ShardCoordinator(sys.argv, shards, self.get_setting('shard_workers', 'SHARD_WORKERS'),
+                                       self.get_setting('dead_letter', 'DEAD_LETTER_FILE', 'failed_ids.txt'),
+                                       self.get_setting('stats_file', 'STATS_FILE'), leases)
+        try:
+            coordinator.run()
+        finally:
+            if leases is not None:
+                leases.close()
+        logging.info('Finish %d shards, %d failed! Run time %s' %
+                     (len(coordinator.done), len(coordinator.failed), str(time.time() - self._start)))
+        failed = sorted(set(coordinator.failed) - set(coordinator.done))  # a shard may be done by a later lease
+        if failed:
+            raise CrawlerException('Shards %s failed' % (', '.join(str(i) for i in failed), ))
+
+    @property
+    def shard(self):
+        """
+        Shard crawled by this process.
+        :return: (index, shards) or None if not sharded
+        """
+        index = self.get_option('shard_index')
+        if index is None:
+            return None
+        shards = self.get_setting('shards', 'SHARDS') or 1
+        if not 0 <= index < shards:
+            raise CrawlerException('Invalid shard index %d of %d shards' % (index, shards))
+        return index, shards
+
+    def shard_path(self, path):
+        """
+        Path of a file written by this process, e.g. data/out.shard-2.json in shard 2.
+        :param path:
+        :return: path
+        """
+        from bac.shard import shard_path
+        shard = self.shard
+        return shard_path(path, shard[0] if shard else None)
+
     def open_crawler(self, category=None):
         """
         Start crawler.
@@ -133,6 +318,22 @@ class Engine:
             raise CrawlerException('Invalid crawler %s' % (category,))
         logging.info("Open crawler %s" % (category, ))
         self._crawler = crawler
+        self.stats = CrawlStats()
+        port = self.get_setting('metrics_port', 'METRICS_PORT')
+        if port and self.shard:
+            port += self.shard[0]
+        if port:
+            import asyncio
+            self._metrics_server = self.get_loop().run_until_complete(
+                asyncio.start_server(self._serve_metrics, self.get_config('METRICS_HOST') or '127.0.0.1', port))
+            logging.info('Serve metrics on port %d' % (port, ))
+        checkpoint = self.shard_path(self.get_setting('checkpoint', 'CHECKPOINT_FILE'))
+        if checkpoint:
+            self._journal = CheckpointJournal(checkpoint, self.get_option('resume'),
+                                              self.get_config('CHECKPOINT_INTERVAL') or 5)
+        elif self.get_option('resume'):
+            raise CrawlerException('No checkpoint file to resume')
+        self.get_parse_executor()  # before crawler and pipelines start threads
         self._crawler.open(self)
         for p in self._pipelines:
             p.open_crawler(self._crawler, self)
@@ -150,26 +351,185 @@ class Engine:
 
     def go_through_pipelines(self, item, crawler):
         """
-        Go through pipelines for each item.
+        Go through pipelines for each item, called in the executor thread.
+        Async pipelines are run on the event loop.
         :param BaseItem item:
         :param BaseCrawler crawler:
         :return:
         """
+        self.stats.item()
         for p in self._pipelines:
-            item = p.process_item(item, crawler, self)
+            t = time.perf_counter()
+            if p.is_async:
+                import asyncio
+                item = asyncio.run_coroutine_threadsafe(p.async_process_item(item, crawler, self), self._loop).result()
+            else:
+                item = p.process_item(item, crawler, self)
+            self.stats.pipeline(p.__class__.__name__, time.perf_counter() - t, item is None)
             if item is None:
                 break
         return item
 
+    async def report_progress(self):
+        """
+        Log progress line periodically until cancelled.
+        :return:
+        """
+        import asyncio
+        interval = self.get_setting('progress_interval', 'PROGRESS_INTERVAL', 10)
+        if not interval:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            logging.info(self.stats.progress_line())
+
+    async def _serve_metrics(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line or line in (b'\r\n', b'\n'):
+                    break
+            body = self.stats.to_prometheus().encode('utf-8')
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode('ascii') + b'\r\n\r\n' + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def checkpoint(self, ids):
+        """
+        Record ids of a completed request in checkpoint journal.
+        With storage pipelines, ids are journaled after all storage pipelines have flushed items of the request.
+        :param ids:
+        :return:
+        """
+        if self._journal is None:
+            return
+        storages = set(p for p in self._pipelines if p.stores_items)
+        with self._checkpoint_lock:
+            if storages:
+                self._unstored.append([ids, storages])
+            else:
+                self._journal.add(ids)
+
+    def is_done(self, snp):
+        """
+        Whether id is completed in previous run, always false if not resume.
+        :param snp:
+        :return: bool
+        """
+        return self._journal is not None and self._journal.is_done(snp)
+
     def close_crawler(self):
         """
         Close crawler.
         :return:
         """
         logging.info('Close crawler')
-        for p in self._pipelines:
-            p.close_crawler(self._crawler, self)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._parse_executor is not None:
+            self._parse_executor.shutdown(wait=True)
+            self._parse_executor = None
+        error = None
+        for p in reversed(self._pipelines):  # storage pipelines flush before pipelines in front of them close
+            try:
+                p.close_crawler(self._crawler, self)
+            except Exception as e:  # close the others, crawler and journal anyway
+                logging.exception('Close pipeline %s failed' % (type(p).__name__, ))
+                error = error or e
         self._crawler.close(self)
+        if self._unstored:
+            logging.warning('%d requests not flushed by storage pipelines, their ids are not journaled' %
+                            (len(self._unstored), ))
+            self._unstored = []
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        stats_file = self.shard_path(self.get_setting('stats_file', 'STATS_FILE'))
+        if stats_file:
+            self.stats.write(stats_file)
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+            self._loop.run_until_complete(self._metrics_server.wait_closed())
+            self._metrics_server = None
+        if self._loop is not None:
+            self._loop.close()
+            self._loop = None
+        if error is not None:
+            raise error
+
+    @property
+    def pipelines(self):
+        return list(self._pipelines)
+
+    def items_stored(self, pipeline, ids):
+        """
+        Notify pipelines that a storage pipeline has stored items durably, e.g. after a flush.
+        Storage pipelines call it on each flush, even with no items, while holding the lock items are added with.
+        :param BasePipeline pipeline: storage pipeline
+        :param ids: _id of stored items
+        :return:
+        """
+        for p in self._pipelines:
+            p.on_items_stored(pipeline, ids, self._crawler, self)
+        if self._journal is None:
+            return
+        # a flush stores all items the pipeline got before, so requests checkpointed before are stored by it
+        with self._checkpoint_lock:
+            unstored = []
+            for entry in self._unstored:
+                entry[1].discard(pipeline)
+                if entry[1]:
+                    unstored.append(entry)
+                else:
+                    self._journal.add(entry[0])
+            self._unstored = unstored
+
+    @property
+    def pipeline_workers(self):
+        return max(1, self.get_setting('pipeline_workers', 'PIPELINE_WORKERS', 1))
+
+    def get_executor(self):
+        """
+        Get executor to parse responses and run pipelines off the event loop, created on first use.
+        :return: executor
+        :rtype: concurrent.futures.Executor
+        """
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=self.pipeline_workers)
+        return self._executor
+
+    def get_parse_executor(self):
+        """
+        Get process pool to parse responses if --parse-workers is set, created in open_crawler.
+        Workers are started by forkserver (spawn if not available), not forked from the threads of the crawl.
+        :return: executor or None
+        :rtype: concurrent.futures.ProcessPoolExecutor
+        """
+        if self._parse_executor is None:
+            workers = self.get_setting('parse_workers', 'PARSE_WORKERS', 0)
+            if workers > 0:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self._parse_executor = ProcessPoolExecutor(max_workers=workers,
+                                                           mp_context=multiprocessing.get_context(method))
+        return self._parse_executor
+
+    def get_loop(self):
+        """
+        Get event loop of the crawl, created on first use.
+        :return: loop
+        :rtype: asyncio.AbstractEventLoop
+        """
+        if self._loop is None:
+            import asyncio
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+        return self._loop
 
     def get_config(self, key):
         """
@@ -192,6 +552,21 @@ class Engine:
             return getattr(self._options, key)
         return None
 
+    def get_setting(self, option, config, default=None):
+        """
+        Get command option, fall back to config and then to default.
+        :param option: option key
+        :param config: config key
+        :param default:
+        :return: setting
+        """
+        val = self.get_option(option)
+        if val is None or val is False:
+            val = self.get_config(config)
+        if val is None:
+            return default
+        return val
+
     def get_crawler(self, category):
         """
         Get crawler by category.
@@ -199,8 +574,8 @@ class Engine:
         :return: crawler
         :rtype: BaseCrawler
         """
-        if category in self._crawlers:
-            return self._crawlers[category]
+        if category in self._config.CRAWLERS:
+            return self.load_crawler(category)
         else:
             return None
 
@@ -209,19 +584,21 @@ class Engine:
         Get available crawlers.
         :return: list
         """
-        return self._crawlers.keys()
+        return self._config.CRAWLERS.keys()
 
 
 class BaseItem:
     """
     Base item object.
+    A dict given as the only argument is owned by the item, not copied.
     """
+    __slots__ = ('_values', )
 
     def __init__(self, *args, **kwargs):
-        self._values = {}
-        if args or kwargs:  # avoid creating dict for most common case
-            for k, v in dict(*args, **kwargs).items():
-                self._values[k] = v
+        if len(args) == 1 and not kwargs and type(args[0]) is dict:
+            self._values = args[0]
+        else:
+            self._values = dict(*args, **kwargs)
 
     def __getitem__(self, item):
         return self._values[item]
@@ -232,6 +609,9 @@ class BaseItem:
     def __delitem__(self, key):
         del self._values[key]
 
+    def __contains__(self, item):
+        return item in self._values
+
     def __len__(self):
         return len(self._values)
 
@@ -239,19 +619,38 @@ class BaseItem:
         return iter(self._values)
 
     def __str__(self):
-        return json.dumps(self._values)
+        return self.to_json()
 
     def keys(self):
         return self._values.keys()
 
     def copy(self):
-        return self.__class__(self)
+        return self.__class__(dict(self._values))
+
+    def to_bytes(self):
+        """
+        Serialize to json in UTF-8, by orjson or ujson if installed.
+        :return: bytes
+        """
+        return dumps_bytes(self._values)
+
+    def to_json(self):
+        """
+        Serialize to json, by orjson or ujson if installed.
+        :return: str
+        """
+        return dumps_bytes(self._values).decode('utf-8')
 
 
 class BasePipeline:
     """
     Super class for pipeline.
+    Pipelines run in executor threads, set is_async and implement async_process_item to run on the event loop.
+    Storage pipelines set stores_items and call engine.items_stored once items are stored durably.
     """
+    is_async = False
+    stores_items = False
+
     def __init__(self):
         pass
 
@@ -296,6 +695,29 @@ class BasePipeline:
         """
         pass
 
+    def on_items_stored(self, pipeline, ids, crawler, engine):
+        """
+        Called after a storage pipeline has stored items durably.
+
+        :param pipeline: storage pipeline
+        :param ids: _id of stored items
+        :param crawler:
+        :param engine:
+        :return:
+        """
+        pass
+
+    async def async_process_item(self, item, crawler, engine):
+        """
+        Process each item on the event loop if is_async, return BastItem or None to stop.
+
+        :param item:
+        :param crawler:
+        :param engine:
+        :return: BaseItem or None
+        """
+        return self.process_item(item, crawler, engine)
+
 
 class BaseCrawler:
     """
@@ -349,7 +771,7 @@ class BaseCrawler:
 
         :param response:
         :param engine
-        :return: BaseItem, list of BaseItem or None
+        :return: BaseItem, list or generator of BaseItem, or None
         """
         return None
 
@@ -1,106 +1,470 @@
-from bac.core import BaseCrawler
+from bac.core import BaseCrawler, BaseItem, loads_bytes
+from bac.ids import shard_of, IdDeduplicator, MergedIds
+from bac.utils import split_class
 import asyncio
 import aiohttp
-import async_timeout
 import logging
+import os
+import time
 from bac.core import CrawlerException
+from bac.retry import RetryPolicy, RequestError, DeadLetterFile
+from bac.cache import ResponseCache, NotModified
+from bac.inputs import INPUT_FORMATS, open_input, guess_format
+from bac.scheduler import RequestScheduler
+from bac.ratelimit import HostRateLimiter
+from urllib.parse import urlsplit
+
+
+_parse_crawlers = {}
+
+
+def parse_in_process(crawler_class, category, response):
+    """
+    Parse response in a worker process of --parse-workers.
+    Crawler is created once in each process and not opened, parse gets None as engine.
+    :param crawler_class: full class name of crawler
+    :param category:
+    :param response: response text
+    :return: json bytes of item dict list, cheaper to pickle than nested dicts
+    """
+    crawler = _parse_crawlers.get((crawler_class, category))
+    if crawler is None:
+        pkg, cls = split_class(crawler_class)
+        crawler = getattr(__import__(pkg, fromlist=True), cls)(category)
+        _parse_crawlers[(crawler_class, category)] = crawler
+    item = crawler.parse(response, None)
+    if item is None:
+        return b'[]'
+    if isinstance(item, BaseItem):
+        item = [item]
+    return b'[' + b','.join(t.to_bytes() for t in item) + b']'
 
 
 class AsyncApiCrawler(BaseCrawler):
 
+    METHODS = ('get', 'post', 'put', 'patch', 'delete')
+
     def __init__(self, category):
         super().__init__(category)
-        self._speed_limit = False
-        self._limit_num = 10
-        self._sleep_second = 3
-        self._batch = 0
+        self.rate_limit = None  # default requests per second for the host of url
+        self.cache_ignore_params = ('api_key', )  # params not part of cache key
+        self._limiter = None
+        self._retry = None
+        self._timeout = None
+        self._dead_letter = None
+        self._cache = None
+        self._conditional = False
+        self._dedup = None
+        self._shard = None
+        self._input_format = None
+        self._input_column = None
+        self._input_buffer = 1024 * 1024
+        self._stats = None
+        self._scheduler = None
+        self._stage_queue = None
+        self._session = None
 
     def open(self, engine):
         super().open(engine)
-        self._speed_limit = engine.get_config('SPEED_LIMIT')
-        if engine.get_option('speed_limit'):
-            self._speed_limit = engine.get_option('speed_limit')
-        self._limit_num = engine.get_option('speed_limit')
-        if engine.get_option('limit_num'):
-            self._limit_num = engine.get_option('limit_num')
-        self._sleep_second = engine.get_config('SLEEP_SECOND')
-        if engine.get_option('sleep-sec'):
-            self._sleep_second = engine.get_option('sleep_sec')
+        self._limiter = self.create_limiter(engine)
+        self._retry = RetryPolicy(
+            engine.get_setting('max_retries', 'MAX_RETRIES', 4) + 1,
+            engine.get_setting('retry_backoff', 'RETRY_BACKOFF', 0.5),
+            engine.get_config('RETRY_MAX_BACKOFF') or 60
+        )
+        self._timeout = aiohttp.ClientTimeout(total=engine.get_setting('timeout', 'REQUEST_TIMEOUT', 10))
+        self._dead_letter = DeadLetterFile(
+            engine.shard_path(engine.get_setting('dead_letter', 'DEAD_LETTER_FILE', 'failed_ids.txt')))
+        self._cache = self.create_cache(engine)
+        if engine.get_setting('conditional', 'CONDITIONAL_REQUESTS', False):
+            if self._cache is not None and self._cache.readable and self._cache.writable:
+                self._conditional = True
+            else:
+                logging.warning('Conditional requests need response cache in readwrite mode, disabled')
+        merged = engine.get_setting('merged_ids', 'MERGED_IDS_FILE')
+        self._dedup = IdDeduplicator(MergedIds(merged) if merged else None)
+        self._shard = engine.shard
+        self._input_format = engine.get_setting('input_format', 'INPUT_FORMAT')
+        self._input_column = engine.get_setting('input_column', 'INPUT_COLUMN')
+        self._input_buffer = int(engine.get_setting('input_buffer', 'INPUT_BUFFER', 1024) * 1024)
+        self._stats = engine.stats
+        self._session = engine.get_loop().run_until_complete(self.open_session(engine))
+
+    def close(self, engine):
+        if self._session is not None:
+            engine.get_loop().run_until_complete(self._session.close())
+            self._session = None
+        if self._dead_letter is not None:
+            self._dead_letter.close()
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+        if self._dedup is not None and self._dedup.read:
+            d = self._dedup
+            batch = getattr(self, 'max_batch_num', 1)
+            saved = -(-d.read // batch) - -(-d.unique // batch)
+            logging.info('Ids read %d, unique %d, duplicates %d, merged %d, saved %d requests' %
+                         (d.read, d.unique, d.duplicates, d.collapsed, saved))
+        super().close(engine)
+
+    def create_limiter(self, engine):
+        """
+        Create rate limiter, --rate-limit applies to all hosts,
+        otherwise HOST_RATE_LIMITS config and then rate_limit of the crawler.
+        :param engine:
+        :return: limiter
+        :rtype: HostRateLimiter
+        """
+        host_rates = {}
+        if self.rate_limit:
+            host_rates[urlsplit(self.url).hostname] = self.rate_limit
+        host_rates.update(engine.get_config('HOST_RATE_LIMITS') or {})
+        rate = engine.get_option('rate_limit')
+        if rate:
+            host_rates = {}
+        else:
+            rate = engine.get_config('RATE_LIMIT')
+        burst = engine.get_setting('rate_burst', 'RATE_BURST', 1)
+        return HostRateLimiter(rate, burst, host_rates)
+
+    def create_cache(self, engine):
+        """
+        Create response cache if cache dir is set and cache mode is not off.
+        :param engine:
+        :return: cache or None
+        :rtype: ResponseCache
+        """
+        cache_dir = engine.get_setting('cache_dir', 'CACHE_DIR')
+        mode = engine.get_setting('cache_mode', 'CACHE_MODE', 'readwrite')
+        if not cache_dir or mode == 'off':
+            return None
+        size = engine.get_setting('cache_size', 'CACHE_SIZE')
+        return ResponseCache(os.path.join(cache_dir, engine.shard_path('responses.sqlite')), mode,
+                             engine.get_setting('cache_ttl', 'CACHE_TTL'), size * 1024 * 1024 if size else None)
+
+    def cache_key(self, method, url, kwargs):
+        """
+        Get cache key of request.
+        :param method:
+        :param url:
+        :param dict kwargs: request params, data or headers
+        :return: key
+        """
+        params = kwargs.get('params')
+        if params:
+            params = {k: v for k, v in params.items() if k not in self.cache_ignore_params}
+        return ResponseCache.fingerprint(method, url, params, kwargs.get('data', kwargs.get('json')))
+
+    async def open_session(self, engine):
+        """
+        Open client session shared by all requests of the crawl.
+        :param engine:
+        :return: session
+        :rtype: aiohttp.ClientSession
+        """
+        connector = aiohttp.TCPConnector(
+            limit=engine.get_setting('pool_size', 'POOL_SIZE', 100),
+            limit_per_host=engine.get_setting('pool_per_host', 'POOL_PER_HOST', 0),
+            keepalive_timeout=engine.get_setting('keepalive_timeout', 'KEEPALIVE_TIMEOUT', 30),
+            ttl_dns_cache=engine.get_setting('dns_ttl', 'DNS_CACHE_TTL', 300)
+        )
+        return aiohttp.ClientSession(connector=connector)
 
     def process(self, engine):
         super().process(engine)
-        loop = asyncio.get_event_loop()
-        tasks = []
-        for d in self.parse_request(engine):
-            if engine.get_option('verbose'):
-                logging.info('Start %s for %s with %s' % (self.method, self.url, str(d)))
-            tasks.append(self.request_task(engine, self.method, **d))
-        loop.run_until_complete(asyncio.wait(tasks))
-        loop.close()
+        concurrency = engine.get_setting('concurrency', 'CONCURRENCY', 10)
+        self._scheduler = RequestScheduler(lambda d: self.schedule_request(engine, d), concurrency)
+        loop = engine.get_loop()
+        loop.run_until_complete(self.prepare(engine))
+        loop.run_until_complete(self.run(engine))
 
-    async def request_task(self, engine, method, **kwargs):
-        async with aiohttp.ClientSession() as session:
-            res = await self.async_request(session, method, self.url, **kwargs)
-            item = self.parse(res, engine)
-            if item is not None:
-                if isinstance(item, list):
-                    for t in item:
-                        self.pipeline_item(t, engine)
+    async def run(self, engine):
+        """
+        Run requests by scheduler, responses are handed to the pipeline stage by a bounded queue.
+        :param engine:
+        :return:
+        """
+        self._stage_queue = asyncio.Queue(maxsize=engine.get_setting('stage_queue', 'STAGE_QUEUE_SIZE', 100))
+        engine.stats.add_queue('requests', self._scheduler.qsize)
+        engine.stats.add_queue('responses', self._stage_queue.qsize)
+        stages = [asyncio.ensure_future(self.run_stage(engine)) for _ in range(engine.pipeline_workers)]
+        reporter = asyncio.ensure_future(engine.report_progress())
+        try:
+            await self._scheduler.run(self.parse_request(engine))
+            for _ in stages:
+                await self._stage_queue.put(None)
+            await asyncio.gather(*stages)
+        except BaseException:
+            for s in stages:
+                s.cancel()
+            raise
+        finally:
+            reporter.cancel()
+
+    async def run_stage(self, engine):
+        """
+        Take responses from queue, parse them and go through pipelines in the engine executor.
+        :param engine:
+        :return:
+        """
+        loop = engine.get_loop()
+        while True:
+            job = await self._stage_queue.get()
+            if job is None:
+                break
+            res, kwargs, key = job
+            start = time.perf_counter()
+            try:
+                parse_executor = engine.get_parse_executor()
+                if parse_executor is None:
+                    item_ids = await loop.run_in_executor(engine.get_executor(), self.process_response, res, engine)
                 else:
-                    self.pipeline_item(item, engine)
+                    crawler_class = self.__class__.__module__ + '.' + self.__class__.__name__
+                    values = await loop.run_in_executor(parse_executor, parse_in_process, crawler_class,
+                                                        self.category, res)
+                    item_ids = await loop.run_in_executor(engine.get_executor(), self.process_values, values,
+                                                          engine)
+            except Exception as e:
+                logging.exception('Process response failed: %s' % (str(e), ))
+                self._dead_letter.write(self.request_ids(kwargs))
+                continue
+            if key is not None:
+                self._cache.set_parse_seconds(key, time.perf_counter() - start)
+            engine.checkpoint(self.completed_ids(kwargs, item_ids))
+
+    async def prepare(self, engine):
+        """
+        Called on the event loop before requests from parse_request are scheduled.
+        :param engine:
+        :return:
+        """
+        pass
 
-    async def async_request(self, session, method, url, **kwargs):
+    async def schedule_request(self, engine, d):
         """
-        Async request
+        Called by scheduler worker for each request params.
+        :param engine:
+        :param dict d: request params, data or headers
+        :return:
+        """
+        if engine.get_option('verbose'):
+            logging.info('Start %s for %s with %s' % (self.method, self.url, str(d)))
+        await self.request_task(engine, self.method, **d)
+
+    async def request_task(self, engine, method, **kwargs):
+        try:
+            res = await self.async_request(self._session, method, self.url, **kwargs)
+        except RequestError as e:
+            parts = self.split_request(kwargs) if e.timeout else None
+            if parts:
+                logging.warning('Split timed out request into %d requests' % (len(parts), ))
+                for p in parts:
+                    await self.request_task(engine, method, **p)
+                return
+            logging.error('Give up request: %s' % (str(e), ))
+            self._dead_letter.write(self.request_ids(kwargs))
+            return
+        except Exception as e:  # e.g. undecodable body or cache error, ids are not lost silently
+            logging.exception('Request failed: %s' % (str(e), ))
+            self._dead_letter.write(self.request_ids(kwargs))
+            return
+        if isinstance(res, NotModified):  # items are stored by a previous run
+            engine.checkpoint(self.request_ids(kwargs))
+            return
+        key = self.cache_key(method, self.url, kwargs) if self._conditional else None
+        await self._stage_queue.put((res, kwargs, key))
+
+    def process_response(self, res, engine):
+        """
+        Parse response and go through pipelines, run in the engine executor.
+        :param res: response text
+        :param engine:
+        :return: list of _id of parsed items
+        """
+        item = self.parse(res, engine)
+        ids = []
+        if item is not None:
+            if isinstance(item, BaseItem):
+                item = [item]
+            for t in item:
+                ids.append(t['_id'] if '_id' in t else None)
+                self.pipeline_item(t, engine)
+        return ids
+
+    async def async_request(self, session, method, url, use_cache=True, **kwargs):
+        """
+        Async request, retry by retry policy.
+        In conditional mode cached responses with ETag or Last-Modified are revalidated if they were processed,
+        the cached body is returned as NotModified if the server responds 304.
         :param session:
         :param method:
         :param url:
+        :param use_cache: whether use response cache
         :param kwargs:
         :return: response text
+        :raise RequestError: if failed finally
         """
-        if self._speed_limit:
-            if self._batch >= self._limit_num:
-                await asyncio.sleep(self._sleep_second)
-                self._batch = 0
-        self._batch += 1
-        with async_timeout.timeout(10):
-            if method.lower() == 'get':
-                async with session.get(url, **kwargs) as response:
-                    if response.status >= 400:
-                        txt = await response.text()
-                        logging.error(txt)
-                        return []
-                    return await response.text()
-            elif method.lower() == 'post':
-                async with session.post(url, **kwargs) as response:
-                    if response.status >= 400:
-                        txt = await response.text()
-                        logging.error(txt)
-                        return []
-                    return await response.text()
-            elif method.lower() == 'put':
-                async with session.put(url, **kwargs) as response:
-                    if response.status >= 400:
-                        txt = await response.text()
-                        logging.error(txt)
-                        return []
-                    return await response.text()
-            elif method.lower() == 'patch':
-                async with session.patch(url, **kwargs) as response:
-                    if response.status >= 400:
-                        txt = await response.text()
-                        logging.error(txt)
-                        return []
-                    return await response.text()
-            elif method.lower() == 'delete':
-                async with session.delete(url, **kwargs) as response:
-                    if response.status >= 400:
-                        txt = await response.text()
-                        logging.error(txt)
-                        return []
-                    return await response.text()
+        if method.lower() not in self.METHODS:
+            raise CrawlerException('Invalid request method %s' % (method, ))
+        stats = self._stats
+        host = urlsplit(url).hostname
+        key = None
+        entry = None
+        request_kwargs = kwargs
+        if self._cache is not None and use_cache:
+            key = self.cache_key(method, url, kwargs)
+            if self._conditional:
+                entry = self._cache.lookup(key)
+                if entry is not None and not (entry.etag or entry.last_modified):
+                    if entry.fresh:
+                        stats.incr(host, 'cache_hits')
+                        return entry.body
+                    entry = None
+                if entry is not None and entry.parse_seconds is None:  # body not processed, e.g. pipelines failed
+                    entry = None
+                if entry is not None:
+                    headers = dict(kwargs.get('headers') or {})
+                    if entry.etag:
+                        headers['If-None-Match'] = entry.etag
+                    if entry.last_modified:
+                        headers['If-Modified-Since'] = entry.last_modified
+                    request_kwargs = dict(kwargs, headers=headers)
             else:
-                raise CrawlerException('Invalid request method %s' % (method, ))
+                txt = self._cache.get(key)
+                if txt is not None:
+                    stats.incr(host, 'cache_hits')
+                    return txt
+        attempt = 0
+        while True:
+            await self._limiter.acquire(url)
+            start = time.perf_counter()
+            try:
+                async with session.request(method, url, timeout=self._timeout, **request_kwargs) as response:
+                    body = await response.read()
+                    stats.request(host, time.perf_counter() - start, len(body))
+                    if response.status == 304 and entry is not None:
+                        self._cache.touch(key)
+                        stats.count('not_modified')
+                        stats.count('bytes_saved', len(entry.body))
+                        stats.count('parse_seconds_saved', entry.parse_seconds or 0.0)
+                        return NotModified(entry.body)
+                    txt = body.decode(response.get_encoding())
+                    if 200 <= response.status < 300:
+                        if key is not None:
+                            self._cache.set(key, txt, response.headers.get('ETag'),
+                                            response.headers.get('Last-Modified'))
+                        self.observe_response(kwargs, time.perf_counter() - start, len(body))
+                        return txt
+                    retry_after = None
+                    if response.status in (429, 503):
+                        retry_after = self._retry.parse_retry_after(response.headers.get('Retry-After'))
+                    error = RequestError('HTTP %d from %s: %s' % (response.status, url, txt[:200]),
+                                         response.status, retry_after)
+            except asyncio.TimeoutError:
+                error = RequestError('Timeout for %s' % (url, ), timeout=True)
+                if self.on_timeout(kwargs):
+                    raise error
+            except aiohttp.ClientError as e:
+                error = RequestError('%s for %s: %s' % (e.__class__.__name__, url, str(e)))
+            stats.incr(host, 'errors')
+            attempt += 1
+            if not self._retry.should_retry(error, attempt):
+                raise error
+            stats.incr(host, 'retries')
+            delay = self._retry.get_delay(error, attempt)
+            logging.warning('Retry %d/%d in %.1fs, %s' % (attempt, self._retry.max_attempts - 1, delay, str(error)))
+            await asyncio.sleep(delay)
+
+    def process_values(self, values, engine):
+        """
+        Go through pipelines for items parsed in worker process, run in the engine executor.
+        :param bytes values: json of item dict list
+        :param engine:
+        :return: list of _id of parsed items
+        """
+        ids = []
+        for v in loads_bytes(values):
+            ids.append(v.get('_id'))
+            self.pipeline_item(BaseItem(v), engine)
+        return ids
+
+    def read_ids(self, fpath, engine=None):
+        """
+        Stream raw ids from input file by --input-format, compressed files are decompressed on the fly.
+        Formats in INPUT_READERS config are used besides lines, vcf and tsv.
+        :param fpath: file path, - for stdin
+        :param engine:
+        :return: generator of raw ids
+        """
+        fmt = self._input_format or guess_format(fpath)
+        reader = INPUT_FORMATS.get(fmt)
+        if reader is None and engine is not None:
+            name = (engine.get_config('INPUT_READERS') or {}).get(fmt)
+            if name:
+                pkg, func = split_class(name)
+                reader = getattr(__import__(pkg, fromlist=True), func)
+        if reader is None:
+            raise CrawlerException('Invalid input format %s' % (fmt, ))
+        with open_input(fpath, self._input_buffer) as fp:
+            for snp in reader(fp, self._input_column):
+                yield snp
+
+    def filter_ids(self, ids, skip=None):
+        """
+        Normalize ids to rs<number>, collapse merged ids, drop duplicates, ids of other shards and ids to skip.
+        :param ids: iterable of raw ids, e.g. lines of file
+        :param skip: function to check whether skip an id
+        :return: generator of ids
+        """
+        shard = self._shard
+        for snp in self._dedup.filter(ids):
+            if shard is not None and shard_of(snp, shard[1]) != shard[0]:
+                continue
+            if skip is None or not skip(snp):
+                yield snp
+
+    def observe_response(self, kwargs, seconds, size):
+        """
+        Called after each successful response, e.g. to adapt batch size.
+        :param dict kwargs: request params, data or headers
+        :param float seconds: latency
+        :param int size: response bytes
+        :return:
+        """
+        pass
+
+    def on_timeout(self, kwargs):
+        """
+        Called when a request timed out, return True to stop retrying so the request is split by split_request.
+        :param dict kwargs: request params, data or headers
+        :return: bool
+        """
+        return False
+
+    def split_request(self, kwargs):
+        """
+        Split a timed out request into smaller ones.
+        :param dict kwargs: request params, data or headers
+        :return: list of request params or None
+        """
+        return None
+
+    def request_ids(self, kwargs):
+        """
+        Get ids requested by request params, used to record completed and failed requests.
+        :param dict kwargs: request params, data or headers
+        :return: list of ids
+        """
+        return []
+
+    def completed_ids(self, kwargs, item_ids):
+        """
+        Get ids to record for a processed response, ids of the request by default.
+        :param dict kwargs: request params, data or headers
+        :param list item_ids: _id of items parsed from the response
+        :return: list of ids
+        """
+        return self.request_ids(kwargs)
 
     def pipeline_item(self, item, engine):
         if engine.get_option('verbose'):
@@ -0,0 +1,206 @@
+from array import array
+from bisect import bisect_left
+import zlib
+
+
+def rs_number(snp):
+    """
+    Get rs number of SNP id, e.g. 7412 for rs7412 or 7412.
+    :param snp:
+    :return: int or None if not a rs id
+    """
+    if isinstance(snp, int):
+        return snp
+    snp = snp.strip()
+    if snp[:2].lower() == 'rs':
+        snp = snp[2:]
+    if snp.isdigit():
+        return int(snp)
+    return None
+
+
+def shard_of(snp, shards):
+    """
+    Shard of SNP id by hash of rs number, stable across processes and runs.
+    :param snp:
+    :param int shards: number of shards
+    :return: 0 ~ shards - 1
+    """
+    n = rs_number(snp)
+    if n is None:
+        n = zlib.crc32(snp.strip().encode('utf-8'))
+    return (((n * 2654435761) & 0xffffffff) * shards) >> 32
+
+
+class IntSet(object):
+    """
+    Compact set of non-negative integers, e.g. rs numbers.
+
+    Integers are grouped by high 16 bits, each group keeps low 16 bits in a sorted
+    array while sparse and switches to a 8 KB bitmap when dense, so it takes about
+    2 bytes for each integer and never more than 1 bit.
+    """
+    ARRAY_MAX = 4096
+
+    def __init__(self, values=None):
+        self._pages = {}
+        self._len = 0
+        if values is not None:
+            for v in values:
+                self.add(v)
+
+    def add(self, n):
+        """
+        Add integer.
+        :param int n:
+        :return: True if added, False if already in set
+        """
+        key, low = n >> 16, n & 0xFFFF
+        page = self._pages.get(key)
+        if page is None:
+            self._pages[key] = array('H', (low, ))
+        elif isinstance(page, bytearray):
+            mask = 1 << (low & 7)
+            if page[low >> 3] & mask:
+                return False
+            page[low >> 3] |= mask
+        else:
+            i = bisect_left(page, low)
+            if i < len(page) and page[i] == low:
+                return False
+            if len(page) < self.ARRAY_MAX:
+                page.insert(i, low)
+            else:
+                bitmap = bytearray(8192)
+                for v in page:
+                    bitmap[v >> 3] |= 1 << (v & 7)
+                bitmap[low >> 3] |= 1 << (low & 7)
+                self._pages[key] = bitmap
+        self._len += 1
+        return True
+
+    def __contains__(self, n):
+        page = self._pages.get(n >> 16)
+        if page is None:
+            return False
+        low = n & 0xFFFF
+        if isinstance(page, bytearray):
+            return bool(page[low >> 3] & (1 << (low & 7)))
+        i = bisect_left(page, low)
+        return i < len(page) and page[i] == low
+
+    def __len__(self):
+        return self._len
+
+
+def batch_iter(iterable, size):
+    """
+    Group items into lists of size.
+    :param iterable:
+    :param size: int or function returning size of next batch
+    :return: generator of list
+    """
+    get_size = size if callable(size) else lambda: size
+    batch = []
+    n = get_size()
+    for i in iterable:
+        batch.append(i)
+        if len(batch) >= n:
+            yield batch
+            batch = []
+            n = get_size()
+    if batch:
+        yield batch
+
+
+class MergedIds(object):
+    """
+    Map of merged rs numbers to current ones, loaded from a file of two columns (merged, current)
+    such as the first columns of dbSNP RsMergeArch.
+    Numbers are kept in two arrays sorted by merged number, a file sorted by the first column loads fastest.
+    """
+
+    def __init__(self, path):
+        self._old = array('q')
+        self._new = array('q')
+        ordered = True
+        with open(path) as fp:
+            for l in fp:
+                cols = l.split()
+                if len(cols) < 2:
+                    continue
+                old, new = rs_number(cols[0]), rs_number(cols[1])
+                if old is not None and new is not None and old != new:
+                    if ordered and self._old and old < self._old[-1]:
+                        ordered = False
+                    self._old.append(old)
+                    self._new.append(new)
+        if not ordered:  # sort both arrays by an index permutation
+            order = sorted(range(len(self._old)), key=self._old.__getitem__)
+            self._old = array('q', (self._old[i] for i in order))
+            self._new = array('q', (self._new[i] for i in order))
+
+    def __len__(self):
+        return len(self._old)
+
+    def resolve(self, n):
+        """
+        Get current rs number, follow chains of merges.
+        :param int n:
+        :return: int
+        """
+        for _ in range(16):
+            i = bisect_left(self._old, n)
+            if i >= len(self._old) or self._old[i] != n:
+                break
+            n = self._new[i]
+        return n
+
+
+class IdDeduplicator(object):
+    """
+    Streaming filter of SNP ids, normalizes rs ids to rs<number>, collapses merged ids and drops duplicates.
+    """
+
+    def __init__(self, merged=None):
+        """
+        :param MergedIds merged:
+        """
+        self.merged = merged
+        self.read = 0
+        self.duplicates = 0
+        self.collapsed = 0
+        self._seen = IntSet()
+        self._seen_other = set()
+
+    @property
+    def unique(self):
+        return self.read - self.duplicates
+
+    def filter(self, ids):
+        """
+        :param ids: iterable of raw ids, blank ones are ignored
+        :return: generator of unique ids
+        """
+        for snp in ids:
+            snp = snp.strip()
+            if not snp:
+                continue
+            self.read += 1
+            n = rs_number(snp)
+            if n is None:
+                if snp in self._seen_other:
+                    self.duplicates += 1
+                    continue
+                self._seen_other.add(snp)
+                yield snp
+                continue
+            if self.merged is not None:
+                m = self.merged.resolve(n)
+                if m != n:
+                    self.collapsed += 1
+                    n = m
+            if not self._seen.add(n):
+                self.duplicates += 1
+                continue
+            yield 'rs%d' % n
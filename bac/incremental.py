@@ -0,0 +1,85 @@
+from bac.core import dumps_bytes
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+
+
+class ContentHashIndex:
+    """
+    Content hashes of stored items backed by SQLite, keyed by item id.
+    Items are checked first and recorded once stored, safe to share between pipeline threads.
+    """
+
+    COMMIT_EVERY = 1000
+
+    def __init__(self, path, exclude=('updated_at', )):
+        """
+        :param path: SQLite database file
+        :param exclude: fields not hashed, e.g. timestamps stamped by crawlers
+        """
+        self.path = path
+        self.exclude = frozenset(exclude or ())
+        self.new = 0
+        self.changed = 0
+        self.unchanged = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        d = os.path.dirname(path)
+        if d and not os.path.exists(d):
+            os.makedirs(d)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS hashes (id TEXT PRIMARY KEY, hash BLOB)')
+
+    def digest(self, values):
+        """
+        Hash of values without excluded fields, independent of key order.
+        :param values: dict or item
+        :return: bytes
+        """
+        exclude = self.exclude
+        values = {k: values[k] for k in values if k not in exclude}
+        return hashlib.blake2b(dumps_bytes(values, sort_keys=True), digest_size=16).digest()
+
+    def check(self, key, values):
+        """
+        Compare hash of values with the recorded one, nothing is recorded.
+        :param key: item id
+        :param values: dict or item
+        :return: (changed, digest), changed is False if hash is the same as the recorded one
+        """
+        h = self.digest(values)
+        with self._lock:
+            row = self._conn.execute('SELECT hash FROM hashes WHERE id = ?', (str(key), )).fetchone()
+            if row is not None and row[0] == h:
+                self.unchanged += 1
+                return False, h
+            if row is None:
+                self.new += 1
+            else:
+                self.changed += 1
+        return True, h
+
+    def record(self, key, digest):
+        """
+        Record hash of a stored item.
+        :param key: item id
+        :param bytes digest: hash from check
+        :return:
+        """
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO hashes (id, hash) VALUES (?, ?)', (str(key), digest))
+            self._pending += 1
+            if self._pending >= self.COMMIT_EVERY:
+                self._conn.commit()
+                self._pending = 0
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.commit()
+                self._conn.close()
+                self._conn = None
+                logging.info('Content hash index %d new, %d changed, %d unchanged' %
+                             (self.new, self.changed, self.unchanged))
@@ -0,0 +1,127 @@
+import gzip
+import io
+import os
+import sys
+from bac.core import CrawlerException
+
+
+GZIP_MAGIC = b'\x1f\x8b'  # gzip and bgzip, bgzip is gzip of many members
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def open_input(path, buffer_size=1024 * 1024, encoding='utf-8'):
+    """
+    Open input file as text stream, gzip, bgzip and zstd are decompressed on the fly by magic bytes.
+    :param path: file path, - for stdin
+    :param int buffer_size: bytes of read buffer
+    :param encoding:
+    :return: text file object
+    """
+    if path == '-':
+        raw = io.BufferedReader(sys.stdin.buffer, buffer_size)
+    else:
+        raw = open(path, 'rb', buffering=buffer_size)
+    magic = raw.peek(4)[:4]
+    if magic[:2] == GZIP_MAGIC:
+        stream = io.BufferedReader(gzip.GzipFile(fileobj=raw), buffer_size)
+    elif magic == ZSTD_MAGIC:
+        try:
+            import zstandard
+        except ImportError:
+            raw.close()
+            raise CrawlerException('zstandard is required for zstd input')
+        reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+        stream = io.BufferedReader(reader, buffer_size)
+    else:
+        stream = raw
+    return io.TextIOWrapper(stream, encoding=encoding, errors='replace')
+
+
+def guess_format(path):
+    """
+    Guess input format by file name, e.g. vcf for x.vcf.gz.
+    :param path:
+    :return: format name
+    """
+    name = os.path.basename(path).lower()
+    for ext in ('.gz', '.bgz', '.zst'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    if name.endswith('.vcf'):
+        return 'vcf'
+    if name.endswith(('.tsv', '.tab')):
+        return 'tsv'
+    return 'lines'
+
+
+def read_lines(fp, column=None):
+    """
+    One id per line.
+    :param fp: text file object
+    :param column: not used
+    :return: generator of ids
+    """
+    for l in fp:
+        yield l
+
+
+def read_vcf(fp, column=None):
+    """
+    Ids in ID column of VCF, ; delimited ids are split and missing ids (.) are skipped.
+    Only the first columns of each row are split, genotype columns are left untouched.
+    :param fp: text file object
+    :param column: not used
+    :return: generator of ids
+    """
+    for l in fp:
+        if l[0] == '#':
+            continue
+        cols = l.split('\t', 3)
+        if len(cols) < 3:
+            continue
+        ids = cols[2]
+        if ids == '.':
+            continue
+        if ';' in ids:
+            for i in ids.split(';'):
+                if i != '.':
+                    yield i
+        else:
+            yield ids
+
+
+def read_tsv(fp, column=None):
+    """
+    Ids in a column of tab separated file, lines starting with # are skipped.
+    If column is a name, the first line not starting with ## is the header, a leading # is ignored.
+    :param fp: text file object
+    :param column: column name in header line, or 1-based column number, default the first column
+    :return: generator of ids
+    """
+    if column is None or str(column).isdigit():
+        index = int(column or 1) - 1
+    else:
+        index = None
+        for l in fp:
+            if l.startswith('##'):
+                continue
+            header = l.lstrip('#').rstrip('\r\n').split('\t')
+            if column not in header:
+                raise CrawlerException('Column %s not found in input header' % (column, ))
+            index = header.index(column)
+            break
+        if index is None:
+            return
+    for l in fp:
+        if l[0] == '#':
+            continue
+        cols = l.rstrip('\r\n').split('\t', index + 1)
+        if len(cols) > index:
+            yield cols[index]
+
+
+INPUT_FORMATS = {
+    'lines': read_lines,
+    'vcf': read_vcf,
+    'tsv': read_tsv,
+}
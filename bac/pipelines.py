@@ -1,4 +1,13 @@
 from bac.core import BasePipeline
+from bac.core import CrawlerException
+from bac.core import dumps_bytes
+from bac.incremental import ContentHashIndex
+from bac.retry import DeadLetterFile
+import gzip
+import logging
+import os
+import threading
+import time
 
 
 class ConsolePipeline(BasePipeline):
@@ -12,57 +21,312 @@ class ConsolePipeline(BasePipeline):
         return item
 
 
+class IncrementalPipeline(BasePipeline):
+    """
+    Drop items whose content is unchanged since the previous run, put it before storage pipelines.
+    Content hashes without timestamp fields are kept in a SQLite index keyed by _id, the hash of an item
+    is recorded only after all storage pipelines after this one have stored it.
+    """
+
+    def add_arguments(self, argparser):
+        super().add_arguments(argparser)
+        argparser.add_argument('--hash-index', help="SQLite file of item content hashes")
+        argparser.add_argument('--full-refresh', help="Pass all items to storage and rebuild hash index",
+                               action="store_true")
+
+    def open_crawler(self, crawler, engine):
+        super().open_crawler(crawler, engine)
+        path = engine.shard_path(engine.get_setting('hash_index', 'HASH_INDEX_FILE', 'data/hashes.db'))
+        self.full_refresh = engine.get_setting('full_refresh', 'FULL_REFRESH', False)
+        exclude = engine.get_config('HASH_EXCLUDE_FIELDS')
+        self._index = ContentHashIndex(path, ('updated_at', ) if exclude is None else exclude)
+        pipelines = engine.pipelines
+        self._storages = [p for p in pipelines[pipelines.index(self) + 1:] if p.stores_items]
+        if not self._storages:
+            logging.warning('No storage pipeline after IncrementalPipeline, hashes are recorded when items pass')
+        self._pending = {}  # _id: [digest, storage pipelines not stored yet]
+        self._lock = threading.Lock()
+
+    def process_item(self, item, crawler, engine):
+        super().process_item(item, crawler, engine)
+        changed, digest = self._index.check(item['_id'], item)
+        if not changed and not self.full_refresh:
+            return None
+        if not self._storages:
+            self._index.record(item['_id'], digest)
+        else:
+            with self._lock:
+                self._pending[item['_id']] = [digest, len(self._storages)]
+        return item
+
+    def on_items_stored(self, pipeline, ids, crawler, engine):
+        if pipeline not in self._storages:
+            return
+        stored = []
+        with self._lock:
+            for i in ids:
+                p = self._pending.get(i)
+                if p is None:
+                    continue
+                p[1] -= 1
+                if p[1] <= 0:
+                    del self._pending[i]
+                    stored.append((i, p[0]))
+        for i, digest in stored:
+            self._index.record(i, digest)
+
+    def close_crawler(self, crawler, engine):
+        if self._pending:
+            logging.warning('%d items not stored by all storage pipelines, their hashes are not recorded' %
+                            (len(self._pending), ))
+        self._index.close()
+        super().close_crawler(crawler, engine)
+
+
 class JsonLinePipeline(BasePipeline):
     """
     Output item to json file.
+    The file is kept open with a large buffer, optionally compressed and rotated by size.
+    The buffer is flushed by a timer thread, also when no items arrive.
     """
+    COMPRESS_EXT = {'gzip': '.gz', 'zstd': '.zst'}
+    stores_items = True
+
     def process_item(self, item, crawler, engine):
         super().process_item(item, crawler, engine)
-        output = engine.get_option('output')
-        if output is None:
-            output = engine.get_config('STORAGE_OUTPUT')
-        with open(output, 'a') as fp:
-            fp.write(str(item) + '\n')
+        data = item.to_bytes() + b'\n'
+        with self._lock:
+            self._fp.write(data)
+            self._ids.append(item['_id'])
+            self._written += len(data)
+            if self.rotate_size and self._written >= self.rotate_size:
+                self._close_file()
+                self._index += 1
+                self._open_file()
         return item
 
     def add_arguments(self, argparser):
         super().add_arguments(argparser)
         argparser.add_argument('--output', help="Json line output file name")
+        argparser.add_argument('--output-buffer', help="KB of json line write buffer", type=int)
+        argparser.add_argument('--output-flush-interval', help="Seconds between json line flushes", type=float)
+        argparser.add_argument('--output-fsync', help="Fsync json line file on flush", action="store_true")
+        argparser.add_argument('--output-compress', help="Compress json line file", choices=['none', 'gzip', 'zstd'])
+        argparser.add_argument('--output-rotate-size', help="Start a new json line file after MB written", type=float)
+
+    def open_crawler(self, crawler, engine):
+        super().open_crawler(crawler, engine)
+        self.output = engine.shard_path(engine.get_setting('output', 'STORAGE_OUTPUT'))
+        self.buffer_size = int(engine.get_setting('output_buffer', 'STORAGE_BUFFER', 1024) * 1024)
+        self.flush_interval = engine.get_setting('output_flush_interval', 'STORAGE_FLUSH_INTERVAL', 5)
+        self.fsync = engine.get_setting('output_fsync', 'STORAGE_FSYNC', False)
+        self.compress = engine.get_setting('output_compress', 'STORAGE_COMPRESS', 'none')
+        rotate = engine.get_setting('output_rotate_size', 'STORAGE_ROTATE_SIZE')
+        self.rotate_size = int(rotate * 1024 * 1024) if rotate else None
+        if self.compress == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise CrawlerException('zstandard is required for zstd output')
+        self._engine = engine
+        self._lock = threading.Lock()
+        self._index = 1
+        self._raw = None
+        self._fp = None
+        self._ids = []  # _id of items written since last flush
+        self._open_file()
+        self._stop = threading.Event()
+        self._timer = threading.Thread(target=self._flush_periodically, name='jsonline-flush', daemon=True)
+        self._timer.start()
+
+    def close_crawler(self, crawler, engine):
+        self._stop.set()
+        self._timer.join()
+        with self._lock:
+            self._close_file()
+        super().close_crawler(crawler, engine)
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_interval):
+            with self._lock:
+                if self._fp is not None and time.time() - self._flushed >= self.flush_interval:
+                    self._flush()
+
+    def file_path(self):
+        """
+        Get path of current file, e.g. out-0001.jsonl.gz if rotated and compressed by gzip.
+
+        :return: path
+        """
+        path = self.output
+        ext = self.COMPRESS_EXT.get(self.compress, '')
+        if ext and path.endswith(ext):
+            path = path[:-len(ext)]
+        if self.rotate_size:
+            root, e = os.path.splitext(path)
+            path = '%s-%04d%s' % (root, self._index, e)
+        return path + ext
+
+    def _open_file(self):
+        path = self.file_path()
+        d = os.path.dirname(path)
+        if d and not os.path.exists(d):
+            os.makedirs(d)
+        self._raw = open(path, 'ab', buffering=self.buffer_size)
+        if self.compress == 'gzip':
+            self._fp = gzip.GzipFile(fileobj=self._raw, mode='ab')
+        elif self.compress == 'zstd':
+            import zstandard
+            self._fp = zstandard.ZstdCompressor().stream_writer(self._raw, closefd=False)
+        else:
+            self._fp = self._raw
+        self._written = 0
+        self._flushed = time.time()
+
+    def _flush(self):
+        self._fp.flush()
+        if self._fp is not self._raw:
+            self._raw.flush()
+        if self.fsync:
+            os.fsync(self._raw.fileno())
+        self._flushed = time.time()
+        self._stored()
+
+    def _stored(self):
+        ids, self._ids = self._ids, []
+        self._engine.items_stored(self, ids)
+
+    def _close_file(self):
+        if self._fp is None:
+            return
+        if self._fp is not self._raw:
+            self._fp.close()
+        self._raw.flush()
+        if self.fsync:
+            os.fsync(self._raw.fileno())
+        self._raw.close()
+        self._fp = None
+        self._raw = None
+        self._stored()
 
 
 class MongodbPipeline(BasePipeline):
     """
-    Store item in mongodb.
+    Store item in mongodb, upserts are buffered and written by unordered bulk writes.
+    Buffered upserts are also written by a timer thread, failed bulk writes are retried by the next flush
+    and ids failed finally are written to the dead letter file.
     """
+    stores_items = True
+
     def add_arguments(self, argparser):
         super().add_arguments(argparser)
         argparser.add_argument('--mongo-host', help="MongoDB host")
-        argparser.add_argument('--mongo-port', help="MongoDB port")
+        argparser.add_argument('--mongo-port', help="MongoDB port", type=int)
         argparser.add_argument('--mongo-db', help="MongoDB database")
         argparser.add_argument('--mongo-collection', help="MongoDB collection")
+        argparser.add_argument('--mongo-batch-size', help="Items for each MongoDB bulk write", type=int)
+        argparser.add_argument('--mongo-flush-interval', help="Max seconds between MongoDB bulk writes", type=float)
+        argparser.add_argument('--mongo-w', help="MongoDB write concern, number of nodes or majority")
+        argparser.add_argument('--mongo-journal', help="Wait MongoDB journal for writes", action="store_true")
+        argparser.add_argument('--mongo-max-retries', help="Retries of a failed MongoDB bulk write", type=int)
 
     def open_crawler(self, crawler, engine):
         super().open_crawler(crawler, engine)
-        from pymongo import MongoClient
-        host = engine.get_option('mongo-host')
-        if not host:
-            host = engine.get_config('MONGO_HOST')
-        port = engine.get_option('mongo-port')
-        if not port:
-            port = engine.get_config('MONGO_PORT')
-        self.db = engine.get_option('mongo-db')
-        if not self.db:
-            self.db = engine.get_config('MONGO_DB')
-        self.collection = engine.get_option('mongo-collection')
-        if not self.collection:
-            self.collection = engine.get_config('MONGO_COLLECTION')
+        from pymongo import MongoClient, ReplaceOne, WriteConcern
+        self._replace_one = ReplaceOne
+        host = engine.get_setting('mongo_host', 'MONGO_HOST')
+        port = engine.get_setting('mongo_port', 'MONGO_PORT')
+        self.db = engine.get_setting('mongo_db', 'MONGO_DB')
+        self.collection = engine.get_setting('mongo_collection', 'MONGO_COLLECTION')
+        self.batch_size = engine.get_setting('mongo_batch_size', 'MONGO_BATCH_SIZE', 500)
+        self.flush_interval = engine.get_setting('mongo_flush_interval', 'MONGO_FLUSH_INTERVAL', 5)
+        self.max_retries = engine.get_setting('mongo_max_retries', 'MONGO_MAX_RETRIES', 3)
+        w = engine.get_setting('mongo_w', 'MONGO_WRITE_CONCERN')
+        if isinstance(w, str) and w.isdigit():
+            w = int(w)
+        write_concern = WriteConcern(w=w, j=engine.get_setting('mongo_journal', 'MONGO_JOURNAL') or None)
         self.conn = MongoClient(host, port)
+        self._collection = self.conn.get_database(self.db).get_collection(self.collection,
+                                                                          write_concern=write_concern)
+        self._engine = engine
+        self._buffer = []
+        self._ids = []  # _id of buffered upserts
+        self._failures = 0  # bulk writes failed in a row
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+        self._dead_letter = DeadLetterFile(
+            engine.shard_path(engine.get_setting('dead_letter', 'DEAD_LETTER_FILE', 'failed_ids.txt')))
+        self._stop = threading.Event()
+        self._timer = threading.Thread(target=self._flush_periodically, name='mongo-flush', daemon=True)
+        self._timer.start()
 
     def process_item(self, item, crawler, engine):
         super().process_item(item, crawler, engine)
-        self.get_collection().replace_one({'_id': item['_id']}, dict(item), True)
+        op = self._replace_one({'_id': item['_id']}, dict(item), upsert=True)
+        with self._lock:
+            self._buffer.append(op)
+            self._ids.append(item['_id'])
+            if len(self._buffer) >= self.batch_size and (
+                    not self._failures or time.time() - self._flushed >= self.flush_interval):  # retry by interval
+                self.flush()
         return item
 
+    def close_crawler(self, crawler, engine):
+        self._stop.set()
+        self._timer.join()
+        try:
+            with self._lock:
+                self.flush()
+                if self._buffer:  # failed write kept for retry, no more retry on close
+                    logging.error('MongoDB bulk write of %d items failed on close' % (len(self._ids), ))
+                    self._dead_letter.write(self._ids)
+                    self._buffer, self._ids = [], []
+        finally:
+            self._dead_letter.close()
+            self.conn.close()
+        super().close_crawler(crawler, engine)
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_interval):
+            with self._lock:
+                if time.time() - self._flushed >= self.flush_interval:
+                    self.flush()
+
+    def flush(self):
+        """
+        Write buffered upserts by an unordered bulk write, lock must be held.
+        Upserts are kept in buffer if the bulk write failed, and dropped to the dead letter file after max retries.
+        Upserts rejected by server, e.g. document too large, are not retried.
+
+        :return:
+        """
+        from pymongo.errors import BulkWriteError
+        self._flushed = time.time()
+        if not self._buffer:
+            self._engine.items_stored(self, [])
+            return
+        ops, ids = self._buffer, self._ids
+        failed = set()
+        try:
+            self._collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            failed = set(err['index'] for err in errors)
+            logging.error('MongoDB bulk write %d of %d failed: %s' % (len(errors), len(ops), str(errors[:3])))
+            self._dead_letter.write([k for i, k in enumerate(ids) if i in failed])
+        except Exception as e:
+            self._failures += 1
+            if self._failures <= self.max_retries:
+                logging.warning('MongoDB bulk write of %d items failed (%d/%d), retry on next flush: %s' %
+                                (len(ops), self._failures, self.max_retries, str(e)))
+                return
+            logging.error('MongoDB bulk write of %d items failed: %s' % (len(ops), str(e)))
+            self._dead_letter.write(ids)
+            failed = set(range(len(ids)))
+        self._buffer, self._ids = [], []
+        self._failures = 0
+        self._engine.items_stored(self, [k for i, k in enumerate(ids) if i not in failed])
+
     def get_collection(self):
         """
         Get MongoDB collection
@@ -70,4 +334,152 @@ class MongodbPipeline(BasePipeline):
         :return:
         :rtype: Collection
         """
-        return self.conn.get_database(self.db).get_collection(self.collection)
+        return self._collection
+
+
+class ParquetPipeline(BasePipeline):
+    """
+    Store Ensembl variation items in Parquet files by pyarrow.
+    Each flush writes a new part file, e.g. variation-0001.parquet, existing files are never overwritten.
+    Common fields are typed columns, other fields are kept in json column extra,
+    likewise other mapping fields in json field extra of each mapping.
+    """
+    stores_items = True
+    STRING_FIELDS = ('name', 'var_class', 'source', 'ambiguity', 'ancestral_allele', 'minor_allele',
+                     'most_severe_consequence', 'updated_at')
+    MAPPING_FIELDS = (('location', 'string'), ('assembly_name', 'string'), ('seq_region_name', 'string'),
+                      ('start', 'int64'), ('end', 'int64'), ('strand', 'int8'), ('allele_string', 'string'),
+                      ('coord_system', 'string'))
+
+    def add_arguments(self, argparser):
+        super().add_arguments(argparser)
+        argparser.add_argument('--parquet-output', help="Parquet output file name")
+        argparser.add_argument('--parquet-row-group', help="Rows in each Parquet row group", type=int)
+        argparser.add_argument('--parquet-buffer', help="Max MB of rows buffered before writing", type=float)
+        argparser.add_argument('--parquet-compression', help="Parquet compression, e.g. snappy, zstd or none")
+
+    def open_crawler(self, crawler, engine):
+        super().open_crawler(crawler, engine)
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self._pa = pa
+        self._pq = pq
+        self.output = engine.shard_path(engine.get_setting('parquet_output', 'PARQUET_OUTPUT'))
+        self.row_group = engine.get_setting('parquet_row_group', 'PARQUET_ROW_GROUP', 100000)
+        self.buffer_size = int(engine.get_setting('parquet_buffer', 'PARQUET_BUFFER', 64) * 1024 * 1024)
+        self.compression = engine.get_setting('parquet_compression', 'PARQUET_COMPRESSION', 'snappy')
+        mapping = pa.struct([(k, getattr(pa, t)()) for k, t in self.MAPPING_FIELDS] + [('extra', pa.string())])
+        fields = [('_id', pa.string())]
+        fields += [(k, pa.string()) for k in self.STRING_FIELDS]
+        fields += [('MAF', pa.float64()), ('synonyms', pa.list_(pa.string())), ('mappings', pa.list_(mapping)),
+                   ('extra', pa.string())]
+        self.schema = pa.schema(fields)
+        d = os.path.dirname(self.output)
+        if d and not os.path.exists(d):
+            os.makedirs(d)
+        self._index = 1
+        self._engine = engine
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._columns = {f.name: [] for f in self.schema}
+        self._rows = 0
+        self._size = 0
+
+    def process_item(self, item, crawler, engine):
+        super().process_item(item, crawler, engine)
+        extra = {}
+        row = {name: None for name in self._columns}
+        for k in item:
+            v = item[k]
+            if k == 'synonyms' and isinstance(v, list):
+                row[k] = [str(s) for s in v]
+            elif k == '_id' or k in self.STRING_FIELDS:
+                row[k] = None if v is None else str(v)
+            elif k == 'MAF':
+                row[k] = self._float(v)
+            elif k == 'mappings' and isinstance(v, list):
+                row[k] = [self._mapping(m) for m in v]
+            else:
+                extra[k] = v
+        row['extra'] = dumps_bytes(extra).decode('utf-8') if extra else None
+        size = 256 + len(row['extra'] or '') + 128 * len(row['mappings'] or []) + \
+            sum(len(s) for s in row['synonyms'] or [])
+        with self._lock:
+            for k, v in row.items():
+                self._columns[k].append(v)
+            self._rows += 1
+            self._size += size
+            if self._rows >= self.row_group or self._size >= self.buffer_size:
+                self.flush()
+        return item
+
+    def close_crawler(self, crawler, engine):
+        with self._lock:
+            self.flush()
+        super().close_crawler(crawler, engine)
+
+    def file_path(self):
+        """
+        Get path of next part file not existing yet, e.g. variation-0001.parquet for variation.parquet.
+
+        :return: path
+        """
+        root, ext = os.path.splitext(self.output)
+        while True:
+            path = '%s-%04d%s' % (root, self._index, ext)
+            if not os.path.exists(path):
+                return path
+            self._index += 1
+
+    def flush(self):
+        """
+        Write buffered rows to a new part file, lock must be held.
+        The file is written under a temporary name and renamed when complete, so part files are always readable.
+
+        :return:
+        """
+        if not self._rows:
+            self._engine.items_stored(self, [])
+            return
+        table = self._pa.Table.from_pydict(self._columns, schema=self.schema)
+        path = self.file_path()
+        self._pq.write_table(table, path + '.tmp', row_group_size=self.row_group, compression=self.compression)
+        os.replace(path + '.tmp', path)
+        self._index += 1
+        ids = self._columns['_id']
+        self._reset()
+        self._engine.items_stored(self, ids)
+
+    def _mapping(self, m):
+        """
+        Struct of a mapping, fields not in MAPPING_FIELDS or not of their type go to json field extra.
+        :param dict m:
+        :return: dict
+        """
+        row = {}
+        extra = {k: m[k] for k in m}
+        for f, t in self.MAPPING_FIELDS:
+            v = extra.pop(f, None)
+            row[f] = self._mapping_value(v, t)
+            if row[f] is None and v is not None:
+                extra[f] = v
+        row['extra'] = dumps_bytes(extra).decode('utf-8') if extra else None
+        return row
+
+    @staticmethod
+    def _float(v):
+        try:
+            return None if v is None else float(v)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _mapping_value(v, t):
+        if v is None or t == 'string':
+            return v if v is None else str(v)
+        try:
+            return int(v)
+        except (TypeError, ValueError):
+            return None
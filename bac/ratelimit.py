@@ -0,0 +1,77 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+
+class TokenBucket:
+    """
+    Async token bucket, paces acquirers smoothly at rate per second with a burst allowance.
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param float rate: tokens per second
+        :param int burst: max tokens saved up while idle
+        """
+        self.rate = float(rate)
+        self.capacity = max(1, int(burst))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """
+        Wait for a token. Waiters are served in arrival order.
+        :return:
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            self._refill()
+            while self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+
+
+class HostRateLimiter:
+    """
+    Keep a separate token bucket for each host.
+    """
+
+    def __init__(self, default_rate=None, burst=1, host_rates=None):
+        """
+        :param float default_rate: requests per second for hosts not in host_rates, None or 0 for no limit
+        :param int burst: burst allowance of each bucket
+        :param dict host_rates: requests per second by host name
+        """
+        self.default_rate = default_rate
+        self.burst = burst
+        self.host_rates = host_rates or {}
+        self._buckets = {}
+
+    def get_bucket(self, host):
+        """
+        Get bucket for host, None if the host is not limited.
+        :param host:
+        :return: TokenBucket or None
+        """
+        if host not in self._buckets:
+            rate = self.host_rates.get(host, self.default_rate)
+            self._buckets[host] = TokenBucket(rate, self.burst) if rate else None
+        return self._buckets[host]
+
+    async def acquire(self, url):
+        """
+        Wait until a request to url is allowed.
+        :param url:
+        :return:
+        """
+        bucket = self.get_bucket(urlsplit(url).hostname)
+        if bucket is not None:
+            await bucket.acquire()
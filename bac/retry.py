@@ -0,0 +1,117 @@
+import email.utils
+import logging
+import os
+import random
+import time
+from bac.core import CrawlerException
+
+
+class RequestError(CrawlerException):
+    """
+    Request failed with an error status or a transport error.
+    """
+
+    def __init__(self, message, status=None, retry_after=None, timeout=False):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.timeout = timeout
+
+
+class RetryPolicy:
+    """
+    Decide whether a failed request is retried and how long to wait before.
+    """
+
+    def __init__(self, max_attempts=5, backoff=0.5, max_backoff=60):
+        """
+        :param int max_attempts: attempts for each request, including the first one
+        :param float backoff: base seconds of exponential backoff
+        :param float max_backoff: max seconds of exponential backoff
+        """
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def is_retryable(self, error):
+        """
+        Transport errors, timeouts, 408, 429 and 5xx are retryable, other 4xx are not.
+        :param RequestError error:
+        :return: bool
+        """
+        status = error.status
+        return status is None or status in (408, 429) or status >= 500
+
+    def should_retry(self, error, attempt):
+        """
+        :param RequestError error:
+        :param int attempt: attempts made
+        :return: bool
+        """
+        return attempt < self.max_attempts and self.is_retryable(error)
+
+    def get_delay(self, error, attempt):
+        """
+        Seconds to wait before next attempt, Retry-After if the server sent one,
+        otherwise exponential backoff with full jitter.
+        :param RequestError error:
+        :param int attempt: attempts made
+        :return: float
+        """
+        if error.retry_after is not None:
+            return error.retry_after
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    @staticmethod
+    def parse_retry_after(value):
+        """
+        Parse Retry-After header, either delay seconds or a HTTP date.
+        :param value:
+        :return: seconds or None
+        """
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if date is None:
+            return None
+        return max(0.0, date.timestamp() - time.time())
+
+
+class DeadLetterFile:
+    """
+    Append ids of requests failed finally, one id per line, so it can be fed back as input file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._fp = None
+
+    def write(self, ids):
+        """
+        :param ids: list of ids
+        :return:
+        """
+        if not ids:
+            return
+        if self._fp is None:
+            d = os.path.dirname(self.path)
+            if d and not os.path.exists(d):
+                os.makedirs(d)
+            self._fp = open(self.path, 'a')
+        for i in ids:
+            self._fp.write(str(i) + '\n')
+        self._fp.flush()
+        self.count += len(ids)
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+            logging.warning('%d failed ids written to %s' % (self.count, self.path))
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+
+
+class RequestScheduler:
+    """
+    Bounded pool of request workers.
+
+    Requests are pulled lazily from a generator into a bounded queue, so memory
+    stays flat whatever the input size and the producer waits when the workers
+    (and the pipelines they drive) fall behind.
+    """
+
+    def __init__(self, handler, concurrency=10, queue_size=None):
+        """
+        :param handler: coroutine function called with each request
+        :param int concurrency: number of workers
+        :param int queue_size: max pending requests, default twice the concurrency
+        """
+        self._handler = handler
+        self.concurrency = max(1, int(concurrency))
+        self.queue_size = queue_size or self.concurrency * 2
+        self._queue = None
+
+    def qsize(self):
+        """
+        Number of requests waiting for a worker.
+        :return: int
+        """
+        if self._queue is None:
+            return 0
+        return self._queue.qsize()
+
+    async def run(self, requests):
+        """
+        Run all requests and wait for the workers to finish.
+        :param requests: iterable of requests
+        :return:
+        """
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        workers = [asyncio.ensure_future(self._work()) for _ in range(self.concurrency)]
+        try:
+            for req in requests:
+                await self._queue.put(req)
+            for _ in workers:
+                await self._queue.put(None)
+            await asyncio.gather(*workers)
+        except BaseException:
+            for w in workers:
+                w.cancel()
+            raise
+
+    async def _work(self):
+        while True:
+            req = await self._queue.get()
+            if req is None:
+                break
+            try:
+                await self._handler(req)
+            except Exception as e:
+                logging.exception('Request failed: %s' % (str(e), ))
+
+
+class AdaptiveBatchSize:
+    """
+    AIMD controller of batch size: grows by a step while batches are fast,
+    halves when a batch is slower than target latency, too large or timed out.
+    Batches in flight smaller than current size don't halve it again.
+    """
+
+    def __init__(self, initial=200, minimum=1, maximum=1000, target_latency=5.0, max_bytes=None, step=None):
+        """
+        :param int initial: initial batch size
+        :param int minimum:
+        :param int maximum:
+        :param float target_latency: seconds a batch should take at most
+        :param int max_bytes: max response bytes of a batch, None for no limit
+        :param int step: additive increase, default 5% of maximum
+        """
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.size = min(self.maximum, max(self.minimum, initial))
+        self.target_latency = target_latency
+        self.max_bytes = max_bytes
+        self.step = step or max(1, self.maximum // 20)
+
+    def __call__(self):
+        return self.size
+
+    def _decrease(self, size):
+        if size < self.size:  # batch sent before an earlier decrease, already accounted for
+            return
+        self.size = max(self.minimum, size // 2)
+
+    def observe(self, size, seconds, nbytes=0):
+        """
+        Adjust by a completed batch.
+        :param int size: ids in batch
+        :param float seconds: latency
+        :param int nbytes: response bytes
+        :return:
+        """
+        if seconds > self.target_latency or (self.max_bytes and nbytes > self.max_bytes):
+            self._decrease(size)
+        elif size >= self.size and seconds < self.target_latency / 2:
+            self.size = min(self.maximum, self.size + self.step)
+
+    def timeout(self, size):
+        """
+        Shrink after a batch timed out.
+        :param int size: ids in batch
+        :return:
+        """
+        self._decrease(size)
@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from bac.stats import CrawlStats, merge_snapshots
+
+
+def shard_path(path, index):
+    """
+    Path of a per-shard file, e.g. data/out.shard-2.json for data/out.json.
+    :param path:
+    :param index: shard index, None for path itself
+    :return: path
+    """
+    if not path or index is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return '%s.shard-%d%s' % (root, index, ext)
+
+
+class ShardLeases:
+    """
+    Work queue of shards shared by nodes, backed by a SQLite lease table.
+    A leased shard goes back to the queue if its lease expires, e.g. the node died.
+    """
+
+    def __init__(self, path, shards, lease_timeout=600, max_attempts=3):
+        """
+        :param path: SQLite database file on storage shared by nodes
+        :param int shards: number of shards
+        :param float lease_timeout: seconds before an unrenewed lease expires
+        :param int max_attempts: leases of a shard before it is given up
+        """
+        self.path = path
+        self.shards = shards
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        d = os.path.dirname(path)
+        if d and not os.path.exists(d):
+            os.makedirs(d)
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS leases (shard INTEGER PRIMARY KEY, shards INTEGER, '
+                           'state TEXT, owner TEXT, lease_until REAL, attempts INTEGER)')
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._conn.execute('SELECT shards FROM leases LIMIT 1').fetchone()
+            if row is not None and row[0] != shards:
+                raise ValueError('Work queue %s has %d shards, not %d' % (path, row[0], shards))
+            self._conn.executemany('INSERT OR IGNORE INTO leases VALUES (?, ?, ?, NULL, 0, 0)',
+                                   [(i, shards, 'pending') for i in range(shards)])
+            self._conn.execute('COMMIT')
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+
+    def lease(self):
+        """
+        Lease next pending or expired shard.
+        :return: shard index or None if no shard left to lease
+        """
+        now = time.time()
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._conn.execute(
+                "SELECT shard FROM leases WHERE attempts < ? AND "
+                "(state = 'pending' OR (state = 'leased' AND lease_until < ?)) ORDER BY shard LIMIT 1",
+                (self.max_attempts, now)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE leases SET state = 'leased', owner = ?, lease_until = ?, "
+                                   "attempts = attempts + 1 WHERE shard = ?",
+                                   (self.owner, now + self.lease_timeout, row[0]))
+            self._conn.execute('COMMIT')
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        return None if row is None else row[0]
+
+    def renew(self, shard):
+        """
+        Extend lease of a running shard.
+        :param int shard:
+        :return: bool, False if the lease was taken by another node
+        """
+        cur = self._conn.execute("UPDATE leases SET lease_until = ? WHERE shard = ? AND owner = ? AND state = 'leased'",
+                                 (time.time() + self.lease_timeout, shard, self.owner))
+        return cur.rowcount > 0
+
+    def complete(self, shard, ok=True):
+        """
+        Mark shard done, or put it back to the queue if failed.
+        :param int shard:
+        :param bool ok:
+        :return:
+        """
+        self._conn.execute('UPDATE leases SET state = ?, owner = NULL, lease_until = 0 WHERE shard = ? AND owner = ?',
+                           ('done' if ok else 'pending', shard, self.owner))
+
+    def counts(self):
+        """
+        Number of shards by state.
+        :return: dict
+        """
+        return dict(self._conn.execute('SELECT state, COUNT(*) FROM leases GROUP BY state'))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class ShardCoordinator:
+    """
+    Run shards of a crawl in worker processes, each is the same command line with --shard-index.
+    Shards are taken in order, or leased from a shared work queue so nodes can run the same crawl.
+    Stats and dead letter files of shards are merged at the end.
+    """
+
+    POLL_INTERVAL = 1
+
+    def __init__(self, argv, shards, workers=None, dead_letter=None, stats_file=None, leases=None):
+        """
+        :param list argv: command line of the crawl, without --shard-index
+        :param int shards: number of shards
+        :param int workers: max worker processes at the same time, default shards
+        :param dead_letter: dead letter file shards are merged into
+        :param stats_file: stats file shards are merged into
+        :param ShardLeases leases: work queue, None to run all shards locally
+        """
+        self.argv = list(argv)
+        self.shards = shards
+        self.workers = workers or shards
+        self.dead_letter = dead_letter
+        self.stats_file = stats_file
+        self.leases = leases
+        self.done = []
+        self.failed = []
+        self._tmp = None
+        self._pending = None if leases else list(range(shards))
+
+    def next_shard(self):
+        if self.leases is not None:
+            return self.leases.lease()
+        return self._pending.pop(0) if self._pending else None
+
+    def command(self, shard):
+        """
+        Command line of a shard worker process.
+        :param int shard:
+        :return: list
+        """
+        cmd = [sys.executable] + self.argv + ['--shard-index', str(shard)]
+        if not self.stats_file:
+            cmd += ['--stats-file', os.path.join(self._tmp, 'stats.json')]
+        return cmd
+
+    def run(self):
+        """
+        Run shards until all done or no shard left to lease.
+        :return: merged stats snapshot
+        """
+        self._tmp = tempfile.mkdtemp(prefix='bac-shards-')
+        running = {}
+        renewed = time.time()
+        try:
+            while True:
+                while len(running) < self.workers:
+                    shard = self.next_shard()
+                    if shard is None:
+                        break
+                    logging.info('Start shard %d/%d' % (shard, self.shards))
+                    running[shard] = subprocess.Popen(self.command(shard))
+                if not running:
+                    break
+                time.sleep(self.POLL_INTERVAL)
+                for shard, p in list(running.items()):
+                    code = p.poll()
+                    if code is None:
+                        continue
+                    del running[shard]
+                    if code == 0:
+                        self.done.append(shard)
+                        logging.info('Shard %d done' % (shard, ))
+                    else:
+                        self.failed.append(shard)
+                        logging.error('Shard %d failed with exit code %d' % (shard, code))
+                    if self.leases is not None:
+                        self.leases.complete(shard, code == 0)
+                if self.leases is not None and time.time() - renewed >= self.leases.lease_timeout / 3:
+                    for shard in running:
+                        if not self.leases.renew(shard):
+                            logging.warning('Lease of shard %d lost' % (shard, ))
+                    renewed = time.time()
+        finally:
+            for p in running.values():
+                p.terminate()
+                p.wait()
+            if self.leases is not None:
+                for shard in running:
+                    self.leases.complete(shard, False)
+        snapshot = self.merge()
+        if self.leases is not None:
+            logging.info('Work queue shards %s' % (json.dumps(self.leases.counts(), sort_keys=True), ))
+        return snapshot
+
+    def merge(self):
+        """
+        Merge stats and dead letter files of shards run by this coordinator.
+        :return: merged stats snapshot
+        """
+        shards = sorted(set(self.done + self.failed))
+        stats_file = self.stats_file or os.path.join(self._tmp, 'stats.json')
+        snapshots = []
+        for i in shards:
+            path = shard_path(stats_file, i)
+            if os.path.exists(path):
+                with open(path) as fp:
+                    snapshots.append(json.load(fp))
+        snapshot = merge_snapshots(snapshots)
+        if self.stats_file:
+            with open(self.stats_file, 'w') as fp:
+                json.dump(snapshot, fp, indent=2)
+        failed = 0
+        for i in shards if self.dead_letter else []:
+            path = shard_path(self.dead_letter, i)
+            if not os.path.exists(path):
+                continue
+            with open(path) as fp, open(self.dead_letter, 'a') as out:
+                for l in fp:
+                    out.write(l)
+                    failed += 1
+            os.remove(path)
+        if failed:
+            logging.warning('%d failed ids of shards merged to %s' % (failed, self.dead_letter))
+        logging.info(CrawlStats().summary(snapshot))
+        for name in os.listdir(self._tmp):
+            os.remove(os.path.join(self._tmp, name))
+        os.rmdir(self._tmp)
+        return snapshot
@@ -0,0 +1,307 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets in seconds.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        for i, b in enumerate(self.BUCKETS):
+            if seconds <= b:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Load histogram from to_dict output.
+        :param dict d:
+        :return: histogram
+        """
+        h = cls()
+        buckets = d.get('buckets', {})
+        h.counts = [buckets.get(str(b), 0) for b in cls.BUCKETS]
+        h.count = d.get('count', 0)
+        h.sum = d.get('sum', 0.0)
+        return h
+
+    def merge(self, other):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.sum += other.sum
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket holding the q quantile.
+        :param float q: 0 ~ 1
+        :return: seconds
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= rank:
+                return self.BUCKETS[i]
+        return self.BUCKETS[-1]
+
+    def to_dict(self):
+        return OrderedDict([
+            ('count', self.count), ('sum', self.sum),
+            ('p50', self.percentile(0.5)), ('p90', self.percentile(0.9)), ('p99', self.percentile(0.99)),
+            ('buckets', OrderedDict((str(b), c) for b, c in zip(self.BUCKETS, self.counts)))
+        ])
+
+
+class CrawlStats:
+    """
+    Metrics of a crawl: requests, errors, retries, latency and bytes by host,
+    items and time in each pipeline, and queue depths.
+    """
+
+    HOST_COUNTERS = ('requests', 'errors', 'retries', 'bytes', 'cache_hits')
+
+    def __init__(self):
+        self.start = time.time()
+        self.items = 0
+        self.counters = {}
+        self.hosts = OrderedDict()
+        self.latency = OrderedDict()
+        self.pipelines = OrderedDict()
+        self.queues = OrderedDict()
+        self._lock = threading.Lock()
+        self._last = (self.start, 0, 0)
+
+    def _host(self, host):
+        h = self.hosts.get(host)
+        if h is None:
+            h = self.hosts[host] = OrderedDict((k, 0) for k in self.HOST_COUNTERS)
+            self.latency[host] = Histogram()
+        return h
+
+    def incr(self, host, key, n=1):
+        """
+        Increase counter of host.
+        :param host:
+        :param key: requests, errors, retries, bytes or cache_hits
+        :param n:
+        :return:
+        """
+        self._host(host)[key] += n
+
+    def count(self, key, n=1):
+        """
+        Increase crawl counter, e.g. not_modified.
+        :param key:
+        :param n:
+        :return:
+        """
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def request(self, host, seconds, size):
+        """
+        Record a completed request.
+        :param host:
+        :param float seconds: latency
+        :param int size: bytes received
+        :return:
+        """
+        h = self._host(host)
+        h['requests'] += 1
+        h['bytes'] += size
+        self.latency[host].observe(seconds)
+
+    def item(self):
+        with self._lock:
+            self.items += 1
+
+    def pipeline(self, name, seconds, dropped=False):
+        """
+        Record an item processed by pipeline, called in pipeline threads.
+        :param name: pipeline name
+        :param float seconds: time in process_item
+        :param bool dropped: whether the pipeline returned None
+        :return:
+        """
+        with self._lock:
+            p = self.pipelines.get(name)
+            if p is None:
+                p = self.pipelines[name] = OrderedDict([('items', 0), ('dropped', 0), ('seconds', 0.0)])
+            p['items'] += 1
+            p['seconds'] += seconds
+            if dropped:
+                p['dropped'] += 1
+
+    def add_queue(self, name, qsize):
+        """
+        Register a queue to report its depth.
+        :param name:
+        :param qsize: function returning queue depth
+        :return:
+        """
+        self.queues[name] = qsize
+
+    def snapshot(self):
+        """
+        Get all metrics.
+        :return: dict
+        """
+        elapsed = time.time() - self.start
+        requests = sum(h['requests'] for h in self.hosts.values())
+        with self._lock:
+            pipelines = OrderedDict()
+            for name, p in self.pipelines.items():
+                p = OrderedDict(p)
+                p['items_per_sec'] = p['items'] / elapsed if elapsed else 0.0
+                p['ms_per_item'] = p['seconds'] * 1000 / p['items'] if p['items'] else 0.0
+                pipelines[name] = p
+            counters = OrderedDict(sorted(self.counters.items()))
+        return OrderedDict([
+            ('elapsed', elapsed),
+            ('requests', requests),
+            ('items', self.items),
+            ('requests_per_sec', requests / elapsed if elapsed else 0.0),
+            ('items_per_sec', self.items / elapsed if elapsed else 0.0),
+            ('counters', counters),
+            ('hosts', OrderedDict((k, OrderedDict(v)) for k, v in self.hosts.items())),
+            ('latency', OrderedDict((k, v.to_dict()) for k, v in self.latency.items())),
+            ('pipelines', pipelines),
+            ('queues', OrderedDict((k, q()) for k, q in self.queues.items())),
+        ])
+
+    def progress_line(self):
+        """
+        One line of throughput since last call and totals.
+        :return: str
+        """
+        now = time.time()
+        requests = sum(h['requests'] for h in self.hosts.values())
+        errors = sum(h['errors'] for h in self.hosts.values())
+        last_time, last_requests, last_items = self._last
+        self._last = (now, requests, self.items)
+        dt = (now - last_time) or 1e-9
+        queues = ' '.join('%s=%d' % (k, q()) for k, q in self.queues.items())
+        return 'Progress %d requests (%.1f/s), %d items (%.1f/s), %d errors, queues %s' % (
+            requests, (requests - last_requests) / dt, self.items, (self.items - last_items) / dt, errors, queues)
+
+    def summary(self, snapshot=None):
+        """
+        Multi-line summary of the crawl.
+        :param dict snapshot: metrics to summarize, default current ones
+        :return: str
+        """
+        s = snapshot or self.snapshot()
+        lines = ['Stats: %d requests (%.1f/s), %d items (%.1f/s) in %.1fs' % (
+            s['requests'], s['requests_per_sec'], s['items'], s['items_per_sec'], s['elapsed'])]
+        for host, h in s['hosts'].items():
+            lat = s['latency'][host]
+            lines.append('  %s: %d requests, %d errors, %d retries, %d cache hits, %.1f MB, p50 %gs, p99 %gs' % (
+                host, h['requests'], h['errors'], h['retries'], h['cache_hits'], h['bytes'] / 1048576.0,
+                lat['p50'], lat['p99']))
+        for name, p in s['pipelines'].items():
+            lines.append('  %s: %d items, %d dropped, %.3f ms/item' % (
+                name, p['items'], p['dropped'], p['ms_per_item']))
+        for k, v in s['counters'].items():
+            lines.append('  %s: %s' % (k, round(v, 3) if isinstance(v, float) else v))
+        return '\n'.join(lines)
+
+    def to_prometheus(self):
+        """
+        Metrics in Prometheus text format.
+        :return: str
+        """
+        s = self.snapshot()
+        out = ['bac_items_total %d' % s['items']]
+        for host, h in s['hosts'].items():
+            for k, v in h.items():
+                out.append('bac_%s_total{host="%s"} %d' % (k, host, v))
+            lat = self.latency[host]
+            n = 0
+            for b, c in zip(lat.BUCKETS, lat.counts):
+                n += c
+                le = '+Inf' if b == float('inf') else str(b)
+                out.append('bac_request_seconds_bucket{host="%s",le="%s"} %d' % (host, le, n))
+            out.append('bac_request_seconds_sum{host="%s"} %f' % (host, lat.sum))
+            out.append('bac_request_seconds_count{host="%s"} %d' % (host, lat.count))
+        for name, p in s['pipelines'].items():
+            out.append('bac_pipeline_items_total{pipeline="%s"} %d' % (name, p['items']))
+            out.append('bac_pipeline_dropped_total{pipeline="%s"} %d' % (name, p['dropped']))
+            out.append('bac_pipeline_seconds_total{pipeline="%s"} %f' % (name, p['seconds']))
+        for k, v in s['counters'].items():
+            out.append('bac_%s_total %s' % (k, v))
+        for k, v in s['queues'].items():
+            out.append('bac_queue_depth{queue="%s"} %d' % (k, v))
+        return '\n'.join(out) + '\n'
+
+    def write(self, path):
+        """
+        Write metrics to json file.
+        :param path:
+        :return:
+        """
+        with open(path, 'w') as fp:
+            json.dump(self.snapshot(), fp, indent=2)
+        logging.info('Stats written to %s' % (path, ))
+
+
+def merge_snapshots(snapshots):
+    """
+    Merge metrics of crawls run in parallel, e.g. shards, as one snapshot.
+    :param list snapshots: snapshot dicts
+    :return: dict
+    """
+    elapsed = max([s['elapsed'] for s in snapshots] or [0.0])
+    requests = sum(s['requests'] for s in snapshots)
+    items = sum(s['items'] for s in snapshots)
+    counters = {}
+    hosts = OrderedDict()
+    latency = OrderedDict()
+    pipelines = OrderedDict()
+    for s in snapshots:
+        for k, v in s['counters'].items():
+            counters[k] = counters.get(k, 0) + v
+        for host, h in s['hosts'].items():
+            m = hosts.setdefault(host, OrderedDict((k, 0) for k in CrawlStats.HOST_COUNTERS))
+            for k, v in h.items():
+                m[k] = m.get(k, 0) + v
+            hist = latency.get(host)
+            if hist is None:
+                hist = latency[host] = Histogram()
+            hist.merge(Histogram.from_dict(s['latency'][host]))
+        for name, p in s['pipelines'].items():
+            m = pipelines.setdefault(name, OrderedDict([('items', 0), ('dropped', 0), ('seconds', 0.0)]))
+            m['items'] += p['items']
+            m['dropped'] += p['dropped']
+            m['seconds'] += p['seconds']
+    for p in pipelines.values():
+        p['items_per_sec'] = p['items'] / elapsed if elapsed else 0.0
+        p['ms_per_item'] = p['seconds'] * 1000 / p['items'] if p['items'] else 0.0
+    return OrderedDict([
+        ('elapsed', elapsed),
+        ('requests', requests),
+        ('items', items),
+        ('requests_per_sec', requests / elapsed if elapsed else 0.0),
+        ('items_per_sec', items / elapsed if elapsed else 0.0),
+        ('counters', OrderedDict(sorted(counters.items()))),
+        ('hosts', hosts),
+        ('latency', OrderedDict((k, v.to_dict()) for k, v in latency.items())),
+        ('pipelines', pipelines),
+        ('queues', OrderedDict()),
+    ])
@@ -1,8 +1,30 @@
-import xml.etree.ElementTree as ET
+import atexit
+import builtins
+import sys
+import threading
+import time
 from collections import defaultdict
 import re
 
 
+_lxml_etree = None
+
+
+def lxml_etree():
+    """
+    Get lxml.etree, imported on first use.
+    :return: module or None if lxml is not installed
+    """
+    global _lxml_etree
+    if _lxml_etree is None:
+        try:
+            from lxml import etree
+        except ImportError:  # lxml is optional
+            etree = False
+        _lxml_etree = etree
+    return _lxml_etree or None
+
+
 def split_class(name):
     """
     Get packages and class name.
@@ -17,9 +39,197 @@ def split_class(name):
     return '', name
 
 
+class ImportProfiler(object):
+    """
+    Time first imports of modules in main thread by wrapping __import__, printed at exit like python -X importtime.
+    Time of a module includes its nested imports, self time excludes them.
+    """
+    _installed = None
+
+    def __init__(self, top=30):
+        """
+        :param int top: modules printed, slowest first
+        """
+        self.top = top
+        self.records = []  # (module, self seconds, total seconds)
+        self._stack = []
+        self._import = None
+
+    @classmethod
+    def install(cls):
+        """
+        Start profiling imports, installed once.
+        :return: profiler
+        """
+        if cls._installed is None:
+            p = cls()
+            p._import = builtins.__import__
+            builtins.__import__ = p._profiled_import
+            atexit.register(p.report)
+            cls._installed = p
+        return cls._installed
+
+    def _profiled_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules or threading.current_thread() is not threading.main_thread():
+            return self._import(name, globals, locals, fromlist, level)
+        self._stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            total = time.perf_counter() - start
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += total
+            self.records.append((name, total - nested, total))
+
+    def report(self, fp=None):
+        """
+        Print slowest imports.
+        :param fp: default stderr
+        :return:
+        """
+        fp = fp or sys.stderr
+        total = sum(r[1] for r in self.records)
+        fp.write('Imported %d modules in %.1f ms\n' % (len(self.records), total * 1000))
+        fp.write('%10s | %10s | module\n' % ('self [ms]', 'total [ms]'))
+        for name, own, cumulative in sorted(self.records, key=lambda r: -r[2])[:self.top]:
+            fp.write('%10.1f | %10.1f | %s\n' % (own * 1000, cumulative * 1000, name))
+
+
+_local_names = {}
+_attrib_names = {}
+_ns_pattern = re.compile(r'^@?\{.+?\}(\w+)')
+
+
+def local_name(tag):
+    """
+    Remove namespace of tag, e.g. Rs for {https://www.ncbi.nlm.nih.gov/SNP/docsum}Rs.
+    :param tag:
+    :return: local name
+    """
+    name = _local_names.get(tag)
+    if name is None:
+        name = tag[tag.index('}') + 1:] if tag[:1] == '{' else tag
+        _local_names[tag] = name
+    return name
+
+
+def attrib_name(name):
+    """
+    Key of attribute, @ prefixed, namespaced attributes use local name without @ as XML2Dict.format_xml_dict.
+    :param name:
+    :return: key
+    """
+    key = _attrib_names.get(name)
+    if key is None:
+        key = name[name.index('}') + 1:] if name[:1] == '{' else '@' + name
+        _attrib_names[name] = key
+    return key
+
+
+def element_value(t):
+    """
+    Convert element to the value XML2Dict.format_xml_dict gives for it in a single pass.
+    :param t: element of xml.etree or lxml
+    :return: dict, str or None
+    """
+    value = None
+    multi = None
+    text = t.text
+    for c in t:
+        tag = c.tag
+        if not isinstance(tag, str):  # comments and processing instructions of lxml are dropped by xml.etree,
+            if value is None and c.tail:  # which joins their tails to text until the first element
+                text = (text or '') + c.tail
+            continue
+        if value is None:
+            value = {}
+        k = local_name(tag)
+        v = element_value(c)
+        if k not in value:
+            value[k] = v
+        elif multi is not None and k in multi:
+            value[k].append(v)
+        else:
+            value[k] = [value[k], v]
+            if multi is None:
+                multi = set()
+            multi.add(k)
+    attrib = t.attrib
+    if attrib:
+        if value is None:
+            value = {}
+        for k, v in attrib.items():
+            value[attrib_name(k)] = v
+    if text:
+        text = text.strip()
+        if value is not None:
+            value['#text'] = text
+        else:
+            value = text
+    return value
+
+
+class XMLRecordParser(object):
+    """
+    Incremental XML parser, yields one dict for each record element as soon as it is complete.
+
+    Records have the same shape as XML2Dict with namespaces removed, processed elements are
+    dropped so peak memory is one record instead of the whole document.
+    """
+
+    def __init__(self, record_tag, chunk_size=65536):
+        """
+        :param record_tag: local name of record element, e.g. Rs
+        :param chunk_size: characters fed to parser each time
+        """
+        self.record_tag = record_tag
+        self.chunk_size = chunk_size
+        self.root_tag = None
+        self.root_attrib = {}
+
+    def iterparse(self, data):
+        """
+        Parse XML string or bytes.
+        :param data:
+        :return: generator of record dict
+        """
+        import xml.etree.ElementTree as ET
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        stack = []
+        for i in range(0, len(data), self.chunk_size):
+            parser.feed(data[i:i + self.chunk_size])
+            for rec in self._read_events(parser, stack):
+                yield rec
+        parser.close()
+        for rec in self._read_events(parser, stack):
+            yield rec
+
+    def _read_events(self, parser, stack):
+        for event, elem in parser.read_events():
+            if event == 'start':
+                if not stack:
+                    self.root_tag = local_name(elem.tag)
+                    self.root_attrib = {attrib_name(k): v for k, v in elem.attrib.items()}
+                stack.append(elem)
+                continue
+            stack.pop()
+            if local_name(elem.tag) == self.record_tag:
+                yield element_value(elem)
+                if stack:
+                    stack[-1].remove(elem)
+                elem.clear()
+
+
 class XML2Dict(object):
-    def __init__(self, coding='UTF-8'):
+    def __init__(self, coding='UTF-8', use_lxml=None):
+        """
+        :param coding:
+        :param use_lxml: parse by lxml in loads, default if lxml is installed
+        """
         self._coding = coding
+        self._use_lxml = use_lxml
 
     def _parse_node(self, t):
         d = {t.tag: {} if t.attrib else None}  # the variable 'd' is the constructed target dictionary
@@ -46,9 +256,27 @@ class XML2Dict(object):
             return self.fromstring(fp.read())
 
     def fromstring(self, xml_str):
+        import xml.etree.ElementTree as ET
         t = ET.fromstring(xml_str)
         return self._parse_node(t)
 
+    def loads(self, xml_str):
+        """
+        Parse xml to dict without namespace and with str values in a single pass,
+        same as format_xml_dict(fromstring(xml_str)).
+        :param xml_str:
+        :return: dict
+        """
+        lxml = lxml_etree() if self._use_lxml is not False else None
+        if lxml is not None:
+            if isinstance(xml_str, str):
+                xml_str = xml_str.encode(self._coding)
+            t = lxml.fromstring(xml_str)
+        else:
+            import xml.etree.ElementTree as ET
+            t = ET.fromstring(xml_str)
+        return {local_name(t.tag): element_value(t)}
+
     def format_xml_dict(self, obj):
         """
         Remove namespace and format bytes in dict parsed by xml.
@@ -56,10 +284,9 @@ class XML2Dict(object):
         :return:
         """
         out = {}
-        pattern = re.compile(r'^@?\{.+?\}(\w+)')
         if isinstance(obj, dict):
             for k, v in obj.items():
-                match = pattern.match(k)
+                match = _ns_pattern.match(k)
                 if match:
                     newk = match.group(1)
                     newv = self.format_xml_dict(v)
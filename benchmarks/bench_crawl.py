@@ -0,0 +1,124 @@
+"""
+Benchmark crawlers end to end through the real Engine against the local mock server.
+
+python benchmarks/bench_crawl.py -c variation --ids 20000 --latency 50 -- --concurrency 20
+python benchmarks/bench_crawl.py -c dbsnp --ids 5000 --error-rate 0.01 --throttle-rate 0.02 -- --batch-num 200
+python benchmarks/bench_crawl.py --ids 20000 --etag --runs 2 -- --cache-dir /tmp/bac-cache --conditional
+
+Arguments after -- are passed to the crawler command line.
+"""
+import argparse
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from common import ROOT
+import config
+from bac.core import Engine
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_port(port, timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('Mock server not started on port %d' % port)
+
+
+def make_config(tmp, pipelines):
+    cfg = types.SimpleNamespace(**{k: getattr(config, k) for k in dir(config) if k.isupper()})
+    cfg.LOG_LEVEL = 'warning'
+    cfg.PIPELINES = pipelines
+    cfg.HOST_RATE_LIMITS = {'127.0.0.1': None}
+    cfg.CHECKPOINT_FILE = None
+    cfg.CACHE_DIR = None
+    cfg.PROGRESS_INTERVAL = 0
+    cfg.DEAD_LETTER_FILE = os.path.join(tmp, 'failed_ids.txt')
+    cfg.STORAGE_OUTPUT = os.path.join(tmp, 'out.json')
+    return cfg
+
+
+def main():
+    argv = sys.argv[1:]
+    extra = []
+    if '--' in argv:
+        i = argv.index('--')
+        argv, extra = argv[:i], argv[i + 1:]
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('-c', '--crawler', choices=['variation', 'dbsnp'], default='variation')
+    argparser.add_argument('--ids', help="Number of input ids", type=int, default=10000)
+    argparser.add_argument('--latency', help="Mean ms of mock responses", type=float, default=0)
+    argparser.add_argument('--latency-per-id', help="Ms of mock latency added for each id", type=float, default=0)
+    argparser.add_argument('--jitter', help="Max ms of latency jitter", type=float, default=0)
+    argparser.add_argument('--error-rate', help="Probability of HTTP 500", type=float, default=0)
+    argparser.add_argument('--throttle-rate', help="Probability of HTTP 429", type=float, default=0)
+    argparser.add_argument('--etag', help="Mock server sends ETag and 304 if not modified", action='store_true')
+    argparser.add_argument('--runs', help="Crawl runs against the same mock server", type=int, default=1)
+    argparser.add_argument('--pipelines', help="Pipelines, comma delimiter", default='')
+    args = argparser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix='bac-bench-')
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'benchmarks', 'mock_server.py'),
+                               '--port', str(port), '--latency', str(args.latency), '--jitter', str(args.jitter),
+                               '--latency-per-id', str(args.latency_per_id),
+                               '--error-rate', str(args.error_rate), '--throttle-rate', str(args.throttle_rate),
+                               '--retry-after', '0'] + (['--etag'] if args.etag else []))
+    try:
+        wait_port(port)
+        id_file = os.path.join(tmp, 'ids.txt')
+        with open(id_file, 'w') as fp:
+            for i in range(1, args.ids + 1):
+                fp.write('rs%d\n' % i)
+        url = 'http://127.0.0.1:%d' % port
+        if args.crawler == 'variation':
+            cmd = ['crawl', '-c', 'variation', '--snp-file', id_file, '--ensembl-url', url]
+        else:
+            cmd = ['crawl', '-c', 'dbsnp', '--dbsnp-file', id_file, '--eutils-url', url]
+        pipelines = [p for p in args.pipelines.split(',') if p]
+        for run in range(1, args.runs + 1):
+            engine = Engine(make_config(tmp, pipelines))
+            parser = argparse.ArgumentParser()
+            engine.init_crawler(parser, cmd + extra)
+            t = time.time()
+            engine.parse_arguments(parser.parse_args(cmd + extra))
+            elapsed = time.time() - t
+            s = engine.stats.snapshot()
+            latency = s['latency'].get('127.0.0.1', {})
+            hosts = s['hosts'].get('127.0.0.1', {})
+            if args.runs > 1:
+                print('run          %d' % run)
+            print('crawler      %s' % args.crawler)
+            print('ids          %d' % args.ids)
+            print('elapsed      %.2f s' % elapsed)
+            print('requests     %d (%.1f req/s)' % (s['requests'], s['requests'] / elapsed))
+            print('items        %d (%.1f items/s)' % (s['items'], s['items'] / elapsed))
+            print('errors       %d, retries %d' % (hosts.get('errors', 0), hosts.get('retries', 0)))
+            print('latency      p50 %gs, p99 %gs' % (latency.get('p50', 0), latency.get('p99', 0)))
+            for k, v in s['counters'].items():
+                print('%-12s %s' % (k, round(v, 3) if isinstance(v, float) else v))
+            print('peak RSS     %.1f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
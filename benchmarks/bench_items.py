@@ -0,0 +1,51 @@
+"""
+Micro-benchmark of BaseItem construction and serialization on Ensembl variation records.
+
+python benchmarks/bench_items.py --items 20000
+"""
+import argparse
+import json
+from common import variation_response, timeit
+from bac import core
+from bac.core import BaseItem
+
+
+class DictCopyItem:
+    """
+    Item copying its dict key by key and serialized by json.dumps, as BaseItem before __slots__.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._values = {}
+        if args or kwargs:
+            for k, v in dict(*args, **kwargs).items():
+                self._values[k] = v
+
+    def __str__(self):
+        return json.dumps(self._values)
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--items', help="Items to create and serialize", type=int, default=20000)
+    argparser.add_argument('--repeat', help="Repeat times, best one is reported", type=int, default=5)
+    args = argparser.parse_args()
+    records = list(json.loads(variation_response(['rs%d' % i for i in range(args.items)])).values())
+    backend = 'orjson' if core.orjson is not None else 'ujson' if core.ujson is not None else 'json'
+    base_items = [BaseItem(r) for r in records]
+    copy_items = [DictCopyItem(r) for r in records]
+    cases = [
+        ('construct dict copy', lambda: [DictCopyItem(r) for r in records]),
+        ('construct BaseItem', lambda: [BaseItem(r) for r in records]),
+        ('serialize json.dumps', lambda: [str(t) for t in copy_items]),
+        ('serialize to_bytes (%s)' % backend, lambda: [t.to_bytes() for t in base_items]),
+    ]
+    print('%d items' % args.items)
+    print('%-32s %10s %12s' % ('case', 'ms', 'items/s'))
+    for name, func in cases:
+        t = timeit(func, args.repeat)
+        print('%-32s %10.2f %12.0f' % (name, t * 1000, args.items / t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Benchmark parse throughput of --parse-workers on canned efetch responses.
+
+python benchmarks/bench_parse_workers.py --responses 40 --records 200 --workers 1,2,4
+"""
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from common import efetch_response
+from bac.core import loads_bytes
+from bac.crawlers import parse_in_process
+from crawlers.entrez_crawlers import EntrezSNPCrawler
+
+CRAWLER = 'crawlers.entrez_crawlers.EntrezSNPCrawler'
+
+
+def run(responses, workers):
+    """
+    Parse responses inline if workers is 0, otherwise by a process pool started as the engine does.
+    Items of workers are decoded in this process, as the crawl does before pipelines.
+    :return: seconds, items
+    """
+    t = time.perf_counter()
+    if workers == 0:
+        crawler = EntrezSNPCrawler('dbsnp')
+        items = sum(len(list(crawler.parse(r, None))) for r in responses)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver')) as executor:
+            # warm up processes and crawler imports before timing
+            list(executor.map(parse_in_process, [CRAWLER] * workers, ['dbsnp'] * workers, responses[:workers]))
+            t = time.perf_counter()
+            items = sum(len(loads_bytes(v)) for v in executor.map(parse_in_process, [CRAWLER] * len(responses),
+                                                      ['dbsnp'] * len(responses), responses))
+    return time.perf_counter() - t, items
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--responses', help="Canned responses to parse", type=int, default=40)
+    argparser.add_argument('--records', help="Rs records in each response", type=int, default=200)
+    argparser.add_argument('--workers', help="Worker counts, comma delimiter", default='1,2,4')
+    args = argparser.parse_args()
+    responses = [efetch_response(range(i * args.records + 1, (i + 1) * args.records + 1))
+                 for i in range(args.responses)]
+    print('%d responses of %d records' % (args.responses, args.records))
+    print('%-8s %10s %12s %10s' % ('workers', 'resp/s', 'items/s', 'speedup'))
+    base = None
+    for w in [0] + [int(w) for w in args.workers.split(',')]:
+        t, items = run(responses, w)
+        base = base or t
+        print('%-8s %10.1f %12.1f %9.2fx' % (w or 'inline', len(responses) / t, items / t, base / t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""
+Benchmark XML to dict conversion on dbSNP efetch responses.
+
+python benchmarks/bench_xml.py --records 200
+"""
+import argparse
+import tracemalloc
+from common import efetch_response, timeit
+from bac.utils import XML2Dict, XMLRecordParser, lxml_etree
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--records', help="Rs records in each response", type=int, default=200)
+    argparser.add_argument('--repeat', help="Repeat times, best one is reported", type=int, default=5)
+    args = argparser.parse_args()
+    xml = efetch_response(range(1, args.records + 1))
+    legacy = XML2Dict(use_lxml=False)
+    expected = legacy.format_xml_dict(legacy.fromstring(xml))
+    cases = [
+        ('fromstring + format_xml_dict', lambda: legacy.format_xml_dict(legacy.fromstring(xml))),
+        ('loads (xml.etree)', lambda: legacy.loads(xml)),
+    ]
+    if lxml_etree() is not None:
+        cases.append(('loads (lxml)', lambda: XML2Dict(use_lxml=True).loads(xml)))
+    cases.append(('XMLRecordParser', lambda: list(XMLRecordParser('Rs').iterparse(xml))))
+    assert legacy.loads(xml) == expected
+    if lxml_etree() is not None:
+        assert XML2Dict(use_lxml=True).loads(xml) == expected
+    assert list(XMLRecordParser('Rs').iterparse(xml)) == expected['ExchangeSet']['Rs']
+    print('%d records, %.1f KB' % (args.records, len(xml) / 1024))
+    print('%-30s %10s %10s %12s' % ('converter', 'ms', 'speedup', 'peak KB'))
+    base = None
+    for name, func in cases:
+        t = timeit(func, args.repeat)
+        base = base or t
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%-30s %10.2f %9.2fx %12.1f' % (name, t * 1000, base / t, peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""
+Check EPost/history server mode of the dbsnp crawler end to end against the mock server.
+
+python benchmarks/check_epost.py --ids 5000 --epost-chunk 1200 --batch-num 200 --error-rate 0.2
+
+Checks that ids are uploaded in chunks sharing one WebEnv, that efetch pages each query_key by retstart/retmax
+without gaps or overlaps, and that ids parsed from history pages are journaled while posted ids never returned are
+dead-lettered, so every id ends up either in the checkpoint journal with its item stored or in the dead letter file,
+though the mock history server reorders ids like Entrez. Exits with code 1 if any check fails.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from aiohttp import web
+from bench_crawl import free_port, make_config
+from mock_server import MockServer
+from bac.core import Engine
+
+
+class RecordingServer(MockServer):
+    """
+    Mock server recording efetch pages, EPost never fails so only efetch requests go to the dead letter file.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.pages = {}  # (WebEnv, query_key): list of (retstart, retmax)
+
+    async def efetch(self, request):
+        q = request.query
+        if 'WebEnv' in q:
+            self.pages.setdefault((q['WebEnv'], q['query_key']), []).append(
+                (int(q['retstart']), int(q['retmax'])))
+        return await super().efetch(request)
+
+    async def epost(self, request):
+        rate, self.error_rate = self.error_rate, 0
+        try:
+            return await super().epost(request)
+        finally:
+            self.error_rate = rate
+
+
+def serve(server, port, started):
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(server.app())
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port).start())
+    server.loop = loop
+    started.set()
+    loop.run_forever()
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+
+def read_lines(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as fp:
+        return [l.strip() for l in fp if l.strip()]
+
+
+def check(failures, ok, message):
+    print('%-4s %s' % ('ok' if ok else 'FAIL', message))
+    if not ok:
+        failures.append(message)
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--ids', help="Number of input ids", type=int, default=5000)
+    argparser.add_argument('--epost-chunk', help="Ids for each EPost upload", type=int, default=1200)
+    argparser.add_argument('--batch-num', help="Ids for each efetch page", type=int, default=200)
+    argparser.add_argument('--error-rate', help="Probability of HTTP 500 for efetch", type=float, default=0.2)
+    args = argparser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='bac-epost-')
+    port = free_port()
+    server = RecordingServer(error_rate=args.error_rate, retry_after=0)
+    started = threading.Event()
+    thread = threading.Thread(target=serve, args=(server, port, started), daemon=True)
+    thread.start()
+    started.wait(10)
+    try:
+        ids = ['rs%d' % i for i in range(1, args.ids + 1)]
+        id_file = os.path.join(tmp, 'ids.txt')
+        with open(id_file, 'w') as fp:
+            fp.write('\n'.join(ids) + '\n')
+        cfg = make_config(tmp, ['bac.pipelines.JsonLinePipeline'])
+        cfg.CHECKPOINT_FILE = os.path.join(tmp, 'checkpoint.txt')
+        cmd = ['crawl', '-c', 'dbsnp', '--dbsnp-file', id_file, '--eutils-url', 'http://127.0.0.1:%d' % port,
+               '--dbsnp-epost', '--epost-chunk', str(args.epost_chunk), '--batch-num', str(args.batch_num),
+               '--max-retries', '0']
+        engine = Engine(cfg)
+        parser = argparse.ArgumentParser()
+        engine.init_crawler(parser, cmd)
+        engine.parse_arguments(parser.parse_args(cmd))
+        history = engine.load_crawler('dbsnp')._history
+
+        failures = []
+        chunks = [len(posted) for _, _, posted in history]
+        expected = [min(args.epost_chunk, args.ids - i) for i in range(0, args.ids, args.epost_chunk)]
+        check(failures, chunks == expected, 'EPost chunks %s' % (chunks, ))
+        check(failures, len(set(webenv for webenv, _, _ in history)) == 1, 'EPost chunks share one WebEnv')
+        check(failures, len(set(k for _, k, _ in history)) == len(history), 'EPost chunks have own query_key')
+        check(failures, sorted(server.history) == sorted((w, k) for w, k, _ in history) and
+              all(sorted(server.history[(w, k)]) == sorted(posted) for w, k, posted in history),
+              'Mock server history matches uploaded ids')
+        for webenv, query_key, posted in history:
+            pages = sorted(server.pages.get((webenv, query_key), []))
+            expected = [(s, args.batch_num) for s in range(0, len(posted), args.batch_num)]
+            check(failures, pages == expected, 'query_key %s paged by retstart/retmax, %d pages' %
+                  (query_key, len(pages)))
+        done = read_lines(cfg.CHECKPOINT_FILE)
+        failed = read_lines(cfg.DEAD_LETTER_FILE)
+        stored = set(json.loads(l)['_id'] for l in read_lines(cfg.STORAGE_OUTPUT))
+        check(failures, not set(done) & set(failed), 'Checkpoint and dead letter ids are disjoint, %d and %d ids' %
+              (len(done), len(failed)))
+        check(failures, sorted(done + failed) == sorted(ids), 'Checkpoint and dead letter ids cover all input ids')
+        check(failures, stored == set(done), 'Items stored for checkpoint ids')
+    finally:
+        server.loop.call_soon_threadsafe(server.loop.stop)
+        thread.join(10)
+        shutil.rmtree(tmp, ignore_errors=True)
+    if failures:
+        print('%d checks failed' % (len(failures), ))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Helpers shared by benchmarks, build canned responses from recorded fixtures.
+"""
+import json
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+_rs_pattern = re.compile(r'<Rs rsId="\d+".*?</Rs>', re.S)
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as fp:
+        return fp.read()
+
+
+def efetch_response(ids):
+    """
+    Build efetch XML response for rs numbers from records in efetch_snp.xml.
+    :param ids: rs numbers
+    :return: str
+    """
+    xml = load_fixture('efetch_snp.xml')
+    records = _rs_pattern.findall(xml)
+    start = xml.index(records[0])
+    end = xml.index(records[-1]) + len(records[-1])
+    body = []
+    for i, rs in enumerate(ids):
+        rec = records[i % len(records)]
+        body.append(re.sub(r'rsId="\d+"', 'rsId="%s"' % rs, rec, count=1))
+    return xml[:start] + '\n  '.join(body) + xml[end:]
+
+
+def variation_response(ids):
+    """
+    Build Ensembl variation POST response for rs ids from records in variation.json.
+    :param ids: rs ids, e.g. rs7412
+    :return: str
+    """
+    records = list(json.loads(load_fixture('variation.json')).values())
+    out = {}
+    for i, rs in enumerate(ids):
+        rec = dict(records[i % len(records)])
+        rec['name'] = rs
+        out[rs] = rec
+    return json.dumps(out)
+
+
+def timeit(func, repeat=5):
+    """
+    Best wall time of func in seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        t = time.perf_counter() - t
+        if best is None or t < best:
+            best = t
+    return best
@@ -0,0 +1,132 @@
+"""
+Local stub of Ensembl variation and Entrez E-utilities endpoints serving recorded fixtures.
+
+python benchmarks/mock_server.py --port 8600 --latency 50 --error-rate 0.01 --throttle-rate 0.02
+
+Endpoints:
+- POST /variation/homo_sapiens  Ensembl variation, json body {"ids": [...]}
+- GET|POST /efetch.fcgi  Entrez efetch by id list or WebEnv/query_key/retstart/retmax
+- POST /epost.fcgi  Entrez EPost, ids are deduplicated and sorted by number descending as Entrez history
+
+With --etag, variation and efetch responses carry an ETag and a matching If-None-Match gets 304.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+from aiohttp import web
+from common import efetch_response, variation_response
+
+
+class MockServer:
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, throttle_rate=0, retry_after=1, latency_per_id=0, etag=False):
+        """
+        :param latency: mean ms before response
+        :param latency_per_id: ms added for each requested id
+        :param jitter: max ms added to or removed from latency
+        :param error_rate: probability of HTTP 500
+        :param throttle_rate: probability of HTTP 429 with Retry-After
+        :param retry_after: seconds of Retry-After
+        :param etag: send ETag and respond 304 to matching If-None-Match
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.latency_per_id = latency_per_id
+        self.etag = etag
+        self.not_modified = 0
+        self.history = {}
+        self.requests = 0
+
+    async def delay(self, ids=0):
+        """
+        Sleep for latency, return error response by error rate or throttle rate.
+        :param int ids: number of requested ids
+        :return: response or None
+        """
+        self.requests += 1
+        ms = max(0, self.latency + self.latency_per_id * ids + random.uniform(-self.jitter, self.jitter))
+        if ms:
+            await asyncio.sleep(ms / 1000.0)
+        r = random.random()
+        if r < self.throttle_rate:
+            return web.Response(status=429, text='Too Many Requests', headers={'Retry-After': str(self.retry_after)})
+        if r < self.throttle_rate + self.error_rate:
+            return web.Response(status=500, text='Internal Server Error')
+        return None
+
+    def respond(self, request, text, content_type):
+        if not self.etag:
+            return web.Response(text=text, content_type=content_type)
+        tag = '"%s"' % hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+        if request.headers.get('If-None-Match') == tag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={'ETag': tag})
+        return web.Response(text=text, content_type=content_type, headers={'ETag': tag})
+
+    async def variation(self, request):
+        ids = json.loads(await request.text())['ids']
+        err = await self.delay(len(ids))
+        if err is not None:
+            return err
+        return self.respond(request, variation_response(ids), 'application/json')
+
+    async def efetch(self, request):
+        q = dict(request.query)
+        if request.method == 'POST':
+            q.update(await request.post())
+        if 'id' in q:
+            ids = q['id'].split(',')
+        else:
+            start = int(q.get('retstart', 0))
+            ids = self.history.get((q['WebEnv'], q['query_key']), [])[start:start + int(q.get('retmax', 20))]
+        err = await self.delay(len(ids))
+        if err is not None:
+            return err
+        ids = [i[2:] if i.startswith('rs') else i for i in ids]
+        return self.respond(request, efetch_response(ids), 'text/xml')
+
+    async def epost(self, request):
+        err = await self.delay()
+        if err is not None:
+            return err
+        data = await request.post()
+        webenv = data.get('WebEnv') or 'MCID_%08x' % random.getrandbits(32)
+        query_key = str(len(self.history) + 1)
+        # history server keeps unique ids sorted by number descending, not in posted order
+        self.history[(webenv, query_key)] = sorted(set(data['id'].split(',')), key=lambda i: -int(i.lstrip('rs')))
+        return web.Response(text='<?xml version="1.0" encoding="UTF-8"?>\n<ePostResult><QueryKey>%s</QueryKey>'
+                                 '<WebEnv>%s</WebEnv></ePostResult>' % (query_key, webenv), content_type='text/xml')
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/variation/homo_sapiens', self.variation)
+        app.router.add_get('/efetch.fcgi', self.efetch)
+        app.router.add_post('/efetch.fcgi', self.efetch)
+        app.router.add_post('/epost.fcgi', self.epost)
+        return app
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--host', default='127.0.0.1')
+    argparser.add_argument('--port', type=int, default=8600)
+    argparser.add_argument('--latency', help="Mean ms before response", type=float, default=0)
+    argparser.add_argument('--latency-per-id', help="Ms added for each requested id", type=float, default=0)
+    argparser.add_argument('--jitter', help="Max ms added to or removed from latency", type=float, default=0)
+    argparser.add_argument('--error-rate', help="Probability of HTTP 500", type=float, default=0)
+    argparser.add_argument('--throttle-rate', help="Probability of HTTP 429", type=float, default=0)
+    argparser.add_argument('--etag', help="Send ETag and respond 304 if not modified", action='store_true')
+    argparser.add_argument('--retry-after', help="Seconds of Retry-After for HTTP 429", type=int, default=1)
+    args = argparser.parse_args()
+    server = MockServer(args.latency, args.jitter, args.error_rate, args.throttle_rate, args.retry_after,
+                        args.latency_per_id, args.etag)
+    web.run_app(server.app(), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,66 @@ LOG_TYPE = 'console'
 LOG_FILE = 'parser_error.log'  # log file path if LOG_TYPE is file
 LOG_LEVEL = 'DEBUG'
 
-# Wait for seconds after some requests
-SPEED_LIMIT = False
-LIMIT_NUM = 10
-SLEEP_SECOND = 5
+# Rate limit, requests per second for each host
+# crawlers set a default for their own host, e.g. 3 for Entrez (10 with api key) and 15 for Ensembl
+RATE_LIMIT = None  # requests per second for all hosts, override defaults of crawlers
+RATE_BURST = 1  # requests allowed in a burst after idle
+HOST_RATE_LIMITS = {}  # requests per second by host name, e.g. {'rest.ensembl.org': 15}
+
+# Max concurrent requests, pending requests are read lazily from input
+CONCURRENCY = 10
+
+# Threads to parse responses and run pipelines off the event loop
+# pipelines must be thread safe if more than 1
+PIPELINE_WORKERS = 1
+STAGE_QUEUE_SIZE = 100  # max responses waiting for pipeline workers, requests wait if full
+# Processes to parse responses, 0 to parse in pipeline threads
+# raw bodies are sent to processes, parse of crawlers get None as engine there
+PARSE_WORKERS = 0
+
+# Connection pool shared by all requests of a crawl
+POOL_SIZE = 100  # max connections, 0 for no limit
+POOL_PER_HOST = 0  # max connections to each host, 0 for no limit
+KEEPALIVE_TIMEOUT = 30  # seconds to keep idle connections alive
+DNS_CACHE_TTL = 300  # seconds to cache DNS results
+
+# Request timeout and retry
+REQUEST_TIMEOUT = 10  # seconds before a request times out
+MAX_RETRIES = 4  # max retries for timeouts, 408, 429 and 5xx
+RETRY_BACKOFF = 0.5  # base seconds of exponential backoff with jitter, Retry-After wins if sent
+RETRY_MAX_BACKOFF = 60  # max seconds of exponential backoff
+DEAD_LETTER_FILE = 'data/failed_ids.txt'  # ids of requests failed finally, can be used as input file
+
+# Response cache, keyed by method, url, params and body
+CACHE_DIR = None  # directory of response cache, None to disable
+CACHE_MODE = 'readwrite'  # off, read, write or readwrite
+CACHE_TTL = None  # seconds before cached responses expire, None for never
+CACHE_SIZE = None  # max MB of cached responses, least recently used are evicted
+CONDITIONAL_REQUESTS = False  # revalidate cached responses by ETag or Last-Modified, skip pipelines on 304
+
+# Checkpoint journal of ids in completed requests, skip them by --resume
+CHECKPOINT_FILE = 'data/checkpoint.txt'  # None to disable
+CHECKPOINT_INTERVAL = 5  # seconds between journal flushes, ids are journaled after storage flushed their items
+
+# Shards of input ids by hash of rs number, files of each shard get a .shard-<index> suffix
+SHARDS = 1  # run shards in worker processes if > 1, --shard-index crawls one shard
+SHARD_WORKERS = None  # max shard worker processes at the same time, None for all shards
+WORK_QUEUE = None  # SQLite lease table of shards shared by nodes on shared storage, None to run all shards locally
+LEASE_TIMEOUT = 600  # seconds before lease of a shard of dead node expires
+
+# Input ids are normalized to rs<number> and deduplicated before requesting
+# input files are streamed, gzip, bgzip and zstd (requires zstandard) are decompressed on the fly
+INPUT_FORMAT = None  # lines, vcf (ID column) or tsv, None to guess by file name, e.g. x.vcf.gz is vcf
+INPUT_COLUMN = None  # id column name or 1-based number of tsv input, None for the first column
+INPUT_BUFFER = 1024  # KB of input read buffer
+INPUT_READERS = {}  # more input formats, name: function(fp, column) yielding raw ids, e.g. {'bed': 'mymod.read_bed'}
+MERGED_IDS_FILE = None  # file of merged and current rs ids per line, e.g. dbSNP RsMergeArch, to collapse merged ids
+
+# Crawl stats
+PROGRESS_INTERVAL = 10  # seconds between progress lines, 0 to disable
+STATS_FILE = None  # write crawl stats to json file at close
+METRICS_PORT = None  # serve Prometheus metrics on this port during crawl
+METRICS_HOST = '127.0.0.1'
 
 # crawlers
 CRAWLERS = {
@@ -18,16 +74,46 @@ CRAWLERS = {
 # pipelines
 # execute by order
 PIPELINES = [
+    # 'bac.pipelines.IncrementalPipeline',  # drop items unchanged since previous run, keep before storage
     # 'bac.pipelines.ConsolePipeline',  # print items to console
     # 'bac.pipelines.JsonLinePipeline',  # store items in json line file
+    # 'bac.pipelines.ParquetPipeline',  # store Ensembl variation items in parquet file
     'bac.pipelines.MongodbPipeline'  # store items in mongodb
 ]
 
+# crawlers config
+ENSEMBL_URL = None  # base url of Ensembl REST API, None for http://grch37.rest.ensembl.org
+ADAPTIVE_BATCH = False  # adapt Ensembl batch size (up to 1000) to latency and response size, split timed out batches
+BATCH_TARGET_LATENCY = 5  # seconds an adaptive batch should take at most, keep below REQUEST_TIMEOUT
+BATCH_MAX_RESPONSE_MB = 50  # shrink adaptive batch if response is larger
+NCBI_API_KEY = None  # NCBI API key for Entrez crawlers
+EUTILS_URL = None  # base url of E-utilities, None for https://eutils.ncbi.nlm.nih.gov/entrez/eutils/
+EPOST_CHUNK = 10000  # ids for each EPost upload in --dbsnp-epost mode
+
 # pipelines config
+# incremental
+HASH_INDEX_FILE = 'data/hashes.db'  # SQLite file of item content hashes
+HASH_EXCLUDE_FIELDS = ('updated_at', )  # fields not hashed
+FULL_REFRESH = False  # pass all items to storage and rebuild hash index
 # json line pipeline
 STORAGE_OUTPUT = 'data/out.json'  # default output file for json line
+STORAGE_BUFFER = 1024  # KB of write buffer
+STORAGE_FLUSH_INTERVAL = 5  # seconds between flushes
+STORAGE_FSYNC = False  # fsync on flush
+STORAGE_COMPRESS = 'none'  # none, gzip or zstd, .gz or .zst is appended to file name
+STORAGE_ROTATE_SIZE = None  # start a new file after MB written (before compression), e.g. out-0001.json
+# parquet storage
+PARQUET_OUTPUT = 'data/variation.parquet'  # default output for parquet, parts are variation-0001.parquet ...
+PARQUET_ROW_GROUP = 100000  # rows in each row group
+PARQUET_BUFFER = 64  # max MB of rows buffered before writing
+PARQUET_COMPRESSION = 'snappy'
 # mongo storage
 MONGO_HOST = '192.168.0.21'  # default mongodb host
 MONGO_PORT = 27017  # default mongodb port
 MONGO_DB = 'gparser'  # default mongodb db
 MONGO_COLLECTION = 'gene'  # default mongodb collection
+MONGO_BATCH_SIZE = 500  # items for each bulk write
+MONGO_FLUSH_INTERVAL = 5  # max seconds between bulk writes
+MONGO_WRITE_CONCERN = None  # w of write concern, number of nodes or 'majority', None for server default
+MONGO_JOURNAL = False  # wait journal for writes
+MONGO_MAX_RETRIES = 3  # retries of a failed bulk write before ids go to the dead letter file
@@ -1,4 +1,8 @@
 #! /bin/python
+import sys
+if '--import-profile' in sys.argv:
+    from bac.utils import ImportProfiler
+    ImportProfiler.install()
 import config
 import argparse
 from bac.core import Engine
@@ -14,6 +18,7 @@ def main():
         eng.parse_arguments(args)
     except Exception as e:
         logging.error(str(e))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
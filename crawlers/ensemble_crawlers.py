@@ -1,6 +1,8 @@
 from bac.crawlers import AsyncApiCrawler
 from bac.core import BaseItem
 from bac.core import CrawlerException
+from bac.ids import batch_iter
+from bac.scheduler import AdaptiveBatchSize
 import json
 import time
 
@@ -12,12 +14,13 @@ class EnsembleVariationCrawler(AsyncApiCrawler):
         self.url = 'http://grch37.rest.ensembl.org/variation/homo_sapiens'
         self.method = 'post'
         self.max_batch_num = 200
+        self.rate_limit = 15
+        self.batch_size = None  # AdaptiveBatchSize if --adaptive-batch
 
     def add_arguments(self, argparser):
         super().add_arguments(argparser)
         argparser.add_argument('--snp-ids', help="SNP id list, comma delimiter [" + self.category + ']')
         argparser.add_argument('--snp-file', help="File for SNP id list [" + self.category + ']')
-        argparser.add_argument('--batch-num', help="SNP number for each batch (1 ~ 1000) [" + self.category + ']', type=int)
         argparser.add_argument('--genotypes', help="Include individual genotypes [" + self.category + ']',
                                action='store_true')
         argparser.add_argument('--phenotypes', help="Include phenotypes [" + self.category + ']', action='store_true')
@@ -25,12 +28,25 @@ class EnsembleVariationCrawler(AsyncApiCrawler):
                                action='store_true')
         argparser.add_argument('--population-genotypes', help="Include population genotype frequencies [" + self.category + ']',
                                action='store_true')
+        argparser.add_argument('--adaptive-batch', help="Adapt batch size to latency, split timed out batches [" +
+                               self.category + ']', action='store_true')
+        argparser.add_argument('--batch-target-latency', help="Seconds a batch should take in adaptive batch [" +
+                               self.category + ']', type=float)
+        argparser.add_argument('--ensembl-url', help="Base url of Ensembl REST API [" + self.category + ']')
 
     def open(self, engine):
+        url = engine.get_setting('ensembl_url', 'ENSEMBL_URL')
+        if url:
+            self.url = url.rstrip('/') + '/variation/homo_sapiens'
         super().open(engine)
         n = engine.get_option('batch_num')
         if n:
-            self.max_batch_num = n
+            self.max_batch_num = min(n, 1000)  # Ensembl accepts 1000 ids at most
+        if engine.get_setting('adaptive_batch', 'ADAPTIVE_BATCH'):
+            max_mb = engine.get_config('BATCH_MAX_RESPONSE_MB')
+            self.batch_size = AdaptiveBatchSize(
+                self.max_batch_num, 1, 1000, engine.get_setting('batch_target_latency', 'BATCH_TARGET_LATENCY', 5),
+                max_mb * 1024 * 1024 if max_mb else None)
 
     def parse_request(self, engine):
         params = {}
@@ -40,13 +56,14 @@ class EnsembleVariationCrawler(AsyncApiCrawler):
             params['phenotypes'] = 1
         if engine.get_option('pops'):
             params['pops'] = 1
-        if engine.get_option('population-genotypes'):
+        if engine.get_option('population_genotypes'):
             params['population-genotypes'] = 1
         if engine.get_option('snp_ids'):
-            snps = engine.get_option('snp_ids').split(',')
-            yield {'data': json.dumps({'ids': snps}), 'params': params, 'headers': self.headers}
+            ids = self.filter_ids(engine.get_option('snp_ids').split(','), engine.is_done)
+            for snps in batch_iter(ids, self.batch_size or self.max_batch_num):
+                yield {'data': json.dumps({'ids': snps}), 'params': params, 'headers': self.headers}
         elif engine.get_option('snp_file'):
-            for snps in self.load_snp_file(engine.get_option('snp_file')):
+            for snps in self.load_snp_file(engine.get_option('snp_file'), engine.is_done, engine):
                 yield {'data': json.dumps({'ids': snps}), 'params': params, 'headers': self.headers}
         else:
             raise CrawlerException('Neither snp-ids nor snp-file provided')
@@ -62,25 +79,37 @@ class EnsembleVariationCrawler(AsyncApiCrawler):
             arr.append(BaseItem(d))
         return arr
 
-    def load_snp_file(self, fpath):
+    def request_ids(self, kwargs):
+        return json.loads(kwargs['data'])['ids']
+
+    def observe_response(self, kwargs, seconds, size):
+        if self.batch_size is not None:
+            self.batch_size.observe(len(self.request_ids(kwargs)), seconds, size)
+
+    def on_timeout(self, kwargs):
+        if self.batch_size is None:
+            return False
+        n = len(self.request_ids(kwargs))
+        self.batch_size.timeout(n)
+        return n > 1
+
+    def split_request(self, kwargs):
+        if self.batch_size is None:
+            return None
+        ids = self.request_ids(kwargs)
+        if len(ids) < 2:
+            return None
+        half = len(ids) // 2
+        return [dict(kwargs, data=json.dumps({'ids': ids[:half]})), dict(kwargs, data=json.dumps({'ids': ids[half:]}))]
+
+    def load_snp_file(self, fpath, skip=None, engine=None):
         """
-        Load snp ids from file.
+        Load unique snp id batches from file, streamed by input format.
         :param fpath:
+        :param skip: function to check whether skip an id
+        :param engine:
         :return:
         """
-        snp = []
-        num = 0
-        with open(fpath) as fp:
-            for l in fp:
-                l = l.strip()
-                if l:
-                    snp.append(l)
-                    num += 1
-                if num >= self.max_batch_num:
-                    yield snp
-                    snp = []
-                    num = 0
-            if len(snp) > 0:
-                yield snp
-                snp = []
-        return snp
+        ids = self.filter_ids(self.read_ids(fpath, engine), skip)
+        for snps in batch_iter(ids, self.batch_size or self.max_batch_num):
+            yield snps
@@ -1,7 +1,9 @@
 from bac.crawlers import AsyncApiCrawler
 from bac.core import BaseItem
 from bac.core import CrawlerException
-from bac.utils import XML2Dict
+from bac.ids import batch_iter
+from bac.utils import XMLRecordParser
+import logging
 import time
 
 
@@ -10,52 +12,163 @@ class EntrezSNPCrawler(AsyncApiCrawler):
     def __init__(self, category):
         super().__init__(category)
         self.url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
+        self.epost_url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/epost.fcgi'
+        self.rate_limit = 3
+        self.api_key = None
+        self.max_batch_num = 200
+        self.epost = False
+        self.epost_chunk = 10000
+        self._history = []  # list of (WebEnv, query_key, ids) uploaded by EPost
+        self._returned = set()  # rs ids parsed from history pages
+
+    def open(self, engine):
+        n = engine.get_option('batch_num')
+        if n:
+            self.max_batch_num = n
+        base = engine.get_setting('eutils_url', 'EUTILS_URL')
+        if base:
+            self.url = base.rstrip('/') + '/efetch.fcgi'
+            self.epost_url = base.rstrip('/') + '/epost.fcgi'
+        self.epost = engine.get_option('dbsnp_epost')
+        self.epost_chunk = engine.get_setting('epost_chunk', 'EPOST_CHUNK', self.epost_chunk)
+        self.api_key = engine.get_setting('ncbi_api_key', 'NCBI_API_KEY')
+        if self.api_key:
+            self.rate_limit = 10
+        super().open(engine)
 
     def parse(self, response, engine):
+        """
+        Parse ExchangeSet incrementally, yield one item for each Rs with ExchangeSet attributes.
+        """
         super().parse(response, engine)
-        xml = XML2Dict()
-        r = xml.fromstring(response)
-        a = xml.format_xml_dict(r)
-        if 'ExchangeSet' in a:
-            a = a['ExchangeSet']
-            a['_id'] = 'rs' + a['Rs']['@rsId']
-            a['updated_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
-            return BaseItem(a)
-        return None
+        parser = XMLRecordParser('Rs')
+        updated_at = time.strftime('%Y-%m-%d %H:%M:%S')
+        for rs in parser.iterparse(response):
+            if parser.root_tag != 'ExchangeSet':
+                break
+            d = dict(parser.root_attrib)
+            d['Rs'] = rs
+            d['_id'] = 'rs' + rs['@rsId']
+            d['updated_at'] = updated_at
+            yield BaseItem(d)
 
     def parse_request(self, engine):
         super().parse_request(engine)
         params = {'db': 'snp', 'report': 'XML'}
+        if self.api_key:
+            params['api_key'] = self.api_key
+        if self.epost:
+            for webenv, query_key, ids in self._history:
+                for start in range(0, len(ids), self.max_batch_num):
+                    p = params.copy()
+                    p.update({'WebEnv': webenv, 'query_key': query_key, 'retstart': start,
+                              'retmax': self.max_batch_num})
+                    yield {'params': p, 'headers': self.headers}
+            return
+        for snps in self.load_batches(engine):
+            p = params.copy()
+            p['id'] = ','.join(snps)
+            yield {'params': p, 'headers': self.headers}
+
+    def load_batches(self, engine):
+        """
+        Get id batches from --dbsnp-ids or --dbsnp-file.
+        :param engine:
+        :return: generator of id list
+        """
         if engine.get_option('dbsnp_ids'):
-            snps = engine.get_option('dbsnp_ids').split(',')
-            for snp in snps:
-                p = params.copy()
-                p['id'] = snp
-                yield {'params': p, 'headers': self.headers}
+            snps = self.filter_ids(engine.get_option('dbsnp_ids').split(','), engine.is_done)
+            return batch_iter((s[2:] if s.startswith('rs') else s for s in snps), self.max_batch_num)
         elif engine.get_option('dbsnp_file'):
-            for snp in self.load_snp_file(engine.get_option('dbsnp_file')):
-                p = params.copy()
-                p['id'] = snp
-                yield {'params': p, 'headers': self.headers}
+            return self.load_snp_file(engine.get_option('dbsnp_file'), engine.is_done, engine)
         else:
             raise CrawlerException('Neither dbsnp-ids nor dbsnp-file provided')
 
+    async def prepare(self, engine):
+        """
+        Upload ids by EPost in history mode, results are paged by efetch in parse_request.
+        :param engine:
+        :return:
+        """
+        await super().prepare(engine)
+        if not self.epost:
+            return
+        webenv = None
+        chunk = []
+        for snps in self.load_batches(engine):
+            chunk.extend(snps)
+            if len(chunk) >= self.epost_chunk:
+                webenv = await self.post_ids(chunk[:self.epost_chunk], webenv)
+                chunk = chunk[self.epost_chunk:]
+        if chunk:
+            await self.post_ids(chunk, webenv)
+
+    async def post_ids(self, ids, webenv=None):
+        """
+        Upload ids to history server by EPost.
+        :param list ids:
+        :param webenv: append to this WebEnv if provided
+        :return: WebEnv
+        """
+        import xml.etree.ElementTree as ET
+        data = {'db': 'snp', 'id': ','.join(ids)}
+        if webenv:
+            data['WebEnv'] = webenv
+        if self.api_key:
+            data['api_key'] = self.api_key
+        res = await self.async_request(self._session, 'post', self.epost_url, use_cache=False, data=data)
+        root = ET.fromstring(res)
+        webenv = root.findtext('WebEnv')
+        query_key = root.findtext('QueryKey')
+        if not webenv or not query_key:
+            raise CrawlerException('EPost failed: %s' % (root.findtext('ERROR') or res[:200], ))
+        self._history.append((webenv, query_key, ids))
+        logging.info('EPost %d ids as query_key %s' % (len(ids), query_key))
+        return webenv
+
+    def request_ids(self, kwargs):
+        """
+        Ids of an id list request. A history page has none, the history server may reorder or deduplicate
+        posted ids, so ids of history pages are recorded when parsed and the ones never returned at close.
+        """
+        params = kwargs['params']
+        if 'id' not in params:
+            return []
+        return [i if i.startswith('rs') else 'rs' + i for i in params['id'].split(',')]
+
+    def completed_ids(self, kwargs, item_ids):
+        if 'id' in kwargs['params']:
+            return super().completed_ids(kwargs, item_ids)
+        ids = [i for i in item_ids if i]
+        self._returned.update(ids)
+        return ids
+
+    def close(self, engine):
+        if self._history and self._dead_letter is not None:
+            missing = ['rs' + i for _, _, posted in self._history for i in posted if 'rs' + i not in self._returned]
+            if missing:
+                logging.warning('%d ids posted by EPost not returned by history pages' % (len(missing), ))
+                self._dead_letter.write(missing)
+        super().close(engine)
+
     def add_arguments(self, argparser):
         super().add_arguments(argparser)
         argparser.add_argument('--dbsnp-ids', help="dbSNP id list, comma delimiter [" + self.category + ']')
         argparser.add_argument('--dbsnp-file', help="File for dbSNP id list [" + self.category + ']')
+        argparser.add_argument('--dbsnp-epost', help="Upload ids by EPost and fetch by history server [" +
+                               self.category + ']', action='store_true')
+        argparser.add_argument('--epost-chunk', help="Ids for each EPost upload [" + self.category + ']', type=int)
+        argparser.add_argument('--eutils-url', help="Base url of E-utilities [" + self.category + ']')
+        argparser.add_argument('--ncbi-api-key', help="NCBI API key, allow 10 requests per second [" + self.category + ']')
 
-    def load_snp_file(self, fpath):
+    def load_snp_file(self, fpath, skip=None, engine=None):
         """
-        Load snp ids from file.
+        Load unique snp id batches from file streamed by input format, ids without rs prefix.
         :param fpath:
+        :param skip: function to check whether skip an id
+        :param engine:
         :return:
         """
-        with open(fpath) as fp:
-            for l in fp:
-                l = l.strip()
-                if l:
-                    if l.startswith('rs'):
-                        l = l[2:]
-                    yield l
-        return
+        snps = (s[2:] if s.startswith('rs') else s for s in self.filter_ids(self.read_ids(fpath, engine), skip))
+        for batch in batch_iter(snps, self.max_batch_num):
+            yield batch